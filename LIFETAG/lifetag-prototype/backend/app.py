@@ -1,37 +1,44 @@
 # backend/app.py (UPDATED)
 import os
 import uuid
-import qrcode
-import smtplib
-from email.message import EmailMessage
+import hashlib
+import threading
+from functools import wraps
 from flask import Flask, request, jsonify, send_from_directory
 from werkzeug.utils import secure_filename
-import json
 from utils import (
-    add_alert, add_or_update_stock, create_prescription, register_patient, get_prescription,
+    add_alert, create_prescription, create_prescriptions, register_patient, get_prescription,
     decrement_stock, record_sale, check_expiry_and_create_alerts, read_csv_to_df,
-    write_df_to_csv, MED_STOCK, PRESCRIPTIONS, PATIENTS, ALERTS,
-    find_patients_for_med, get_active_alerts, mark_alert_resolved, touch_alert_last_sent,
-    resolve_alerts_for_stock, check_dispensed_medicine_and_alert  # ADD THIS
+    MED_STOCK, PRESCRIPTIONS, PATIENTS, ALERTS,
+    find_patients_for_med, get_active_alerts, mark_alert_resolved, touch_alerts_last_sent,
+    resolve_alerts_for_stock, check_dispensed_medicine_and_alert,  # ADD THIS
+    bulk_add_or_update_stock, with_expiry, expiring_stock, expired_stock, search_stock, MEDICINE_INDEX,
+    mark_stock_dirty, take_dirty_stock_keys, take_due_stock_keys,
+    index_dispensed_items, insert_sales, sales_rollup, cover_range,
+    prescription_records, patient_snapshot, OUTBOX,
+    STOCK_TABLE, PRESCRIPTIONS_TABLE, PRESCRIPTION_ITEMS_TABLE, PATIENTS_TABLE, ALERTS_TABLE, SALES_ROLLUPS_TABLE
 )
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask_cors import CORS
+import numpy as np
 import pandas as pd
 import cv2
 import pytesseract
 from apscheduler.schedulers.background import BackgroundScheduler
 from urllib.parse import urlencode
+from mailer import transport_from_env
+from responses import FastJSONProvider, compress_response
+from cache import ResultCache, SingleFlight
+from qr import MIMETYPES as QR_MIMETYPES, QRRenderer
 from dotenv import load_dotenv
 from utils import send_email
-from flask import send_file
-import io
 
 load_dotenv()  # Load .env configuration
 
 # --- Config ---
 BASE_DIR = Path(__file__).parent
-UPLOAD_DIR = BASE_DIR / "uploads"
+UPLOAD_DIR = Path(os.getenv("LIFETAG_DATA_DIR") or BASE_DIR / "uploads")
 STATIC_QR_DIR = BASE_DIR / "static" / "qr"
 ALLOWED_EXT = {'csv', 'png', 'jpg', 'jpeg'}
 
@@ -46,14 +53,9 @@ PATIENTS = UPLOAD_DIR / "patients.csv"
 ALERTS = UPLOAD_DIR / "alerts.csv"
 
 # Env values (safely parse)
-SMTP_HOST = os.getenv("SMTP_HOST", "")
-SMTP_PORT = os.getenv("SMTP_PORT", "")
-try:
-    SMTP_PORT = int(SMTP_PORT) if SMTP_PORT else 587
-except Exception:
-    SMTP_PORT = 587
+# SMTP_HOST / SMTP_PORT / SMTP_USER / SMTP_PASS / SMTP_STARTTLS are read by
+# mailer.transport_from_env()
 SMTP_USER = os.getenv("SMTP_USER", "")
-SMTP_PASS = os.getenv("SMTP_PASS", "")
 FROM_EMAIL = os.getenv("FROM_EMAIL") or SMTP_USER or "lifetag@example.com"
 # SITE_BASE fallback to host:port
 SITE_BASE = os.getenv("SITE_BASE") or f"http://{HOST}:{PORT}"
@@ -61,11 +63,14 @@ PHARMACY_EMAIL = os.getenv("PHARMACY_EMAIL") or FROM_EMAIL
 SITE_ADMIN_EMAIL = os.getenv("SITE_ADMIN_EMAIL") or FROM_EMAIL
 
 app = Flask(__name__, static_folder=str(BASE_DIR / "static"), static_url_path="/static")
+app.json = FastJSONProvider(app)        # orjson when installed, handles DataFrame/NumPy values
+app.after_request(compress_response)    # gzip/brotli for larger /api/ responses
 CORS(app, resources={
     r"/api/*": {
         "origins": "*",  # Allow all origins for development
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"]
+        "allow_headers": ["Content-Type", "Authorization", "If-None-Match"],
+        "expose_headers": ["ETag", "X-Next-Cursor"]
     }
 })
 
@@ -73,48 +78,159 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 STATIC_QR_DIR.mkdir(parents=True, exist_ok=True)
 
 # ---------------- Email Helper ----------------
+# Mail from this module goes through the shared outbox on its own "app" channel:
+# the configured SMTP server, or the console when SMTP isn't configured.
+OUTBOX.add_transport("app", transport_from_env(FROM_EMAIL))
+
 def send_email(to_email, subject, body_text, html=None):
+    """Queue an email for background delivery (see mailer.py)."""
     if not to_email:
         app.logger.warning("send_email called without recipient")
         return False
-    msg = EmailMessage()
-    msg['Subject'] = subject
-    msg['From'] = FROM_EMAIL
-    msg['To'] = to_email
-    msg.set_content(body_text)
-    if html:
-        msg.add_alternative(html, subtype='html')
-
-    # If SMTP configured, attempt send; otherwise print to console for debugging
-    if SMTP_HOST and SMTP_USER and SMTP_PASS:
-        try:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20) as s:
-                s.starttls()
-                s.login(SMTP_USER, SMTP_PASS)
-                s.send_message(msg)
-            app.logger.info(f"Email sent to {to_email}: {subject}")
-            return True
-        except Exception as e:
-            app.logger.exception("Failed to send email via SMTP, printing to console")
-            print("---- EMAIL FAILED TO SEND (printed) ----")
-            print("To:", to_email)
-            print("Subject:", subject)
-            print(body_text)
-            if html:
-                print("HTML:", html)
-            return False
-    else:
-        # no SMTP — log/print for local dev
-        app.logger.info("SMTP not configured — printing email to console")
-        print("---- EMAIL (console) ----")
-        print("To:", to_email)
-        print("Subject:", subject)
-        print(body_text)
-        if html:
-            print("HTML:", html)
-        return True
+    OUTBOX.enqueue(to_email, subject, body_text, html, channel="app")
+    return True
 
 # ---------------- Helpers ----------------
+# List endpoints accept, on top of their own parameters:
+#   ?<filter>=value     exact match on the filters each endpoint allows (case-insensitive)
+#   ?from=&to=          ISO date/time range on the endpoint's date column (inclusive)
+#   ?limit=N&after=ID   cursor pagination; the next page's cursor is sent in X-Next-Cursor
+#   ?fields=a,b         only return these keys
+#   ?format=columnar    {"count": n, "fields": [...], "columns": {field: [values]}}
+#                       built from the frame's columns instead of one dict per row
+# Without them the whole list is returned as before.
+MAX_PAGE_SIZE = 1000
+
+class QueryError(ValueError):
+    pass
+
+@app.errorhandler(QueryError)
+def handle_query_error(e):
+    return jsonify({"error": str(e)}), 400
+
+def filter_rows(df, filters=(), date_col=None):
+    """Apply the ?<filter>= and ?from=/?to= parameters to a table frame."""
+    for name in filters:
+        value = request.args.get(name, '').strip()
+        if value and name in df.columns:
+            df = df[df[name].astype(str).str.strip().str.lower() == value.lower()]
+    lo, hi = request.args.get('from', '').strip(), request.args.get('to', '').strip()
+    if (lo or hi) and date_col in df.columns:
+        dates = df[date_col].astype(str)
+        # a bare date in ?to= covers that whole day
+        hi = hi + "\uffff" if len(hi) == 10 else hi
+        df = df[((dates >= lo) if lo else True) & ((dates <= hi) if hi else True)]
+    return df
+
+def paginate(df, default_limit=None):
+    """
+    Apply ?after= and ?limit= (default_limit when there is no ?limit=).
+    Cursors are row ids, so a page continues after the given row whatever
+    order the frame is in. Returns (page, next_cursor).
+    """
+    after = request.args.get('after', '').strip()
+    limit = request.args.get('limit', '').strip()
+    try:
+        after = int(after) if after else None
+        limit = min(int(limit), MAX_PAGE_SIZE) if limit else default_limit
+    except ValueError:
+        raise QueryError("limit and after must be integers")
+    if limit is not None and limit < 1:
+        raise QueryError("limit must be positive")
+    if after is not None:
+        if df.index.is_monotonic_increasing:
+            df = df.iloc[df.index.searchsorted(after, side="right"):]
+        elif after in df.index:
+            df = df.iloc[df.index.get_loc(after) + 1:]
+        else:
+            raise QueryError("unknown cursor")
+    if limit is None or len(df) <= limit:
+        return df, None
+    df = df.iloc[:limit]
+    return df, str(df.index[-1])
+
+def project(records):
+    """Apply ?fields= to a list of dicts."""
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    if not fields:
+        return records
+    return [{f: r[f] for f in fields if f in r} for r in records]
+
+# Conditional GETs: read endpoints get an ETag built from the versions of the
+# tables they read, and a matching If-None-Match is answered with 304 before
+# the handler loads anything. CSV table versions are per process, so their
+# tags also carry a token for this process.
+_ETAG_BOOT = uuid.uuid4().hex[:8]
+
+def table_versions(*tables):
+    """Data version of the given tables; responses include days_to_expiry etc., so the date is part of it."""
+    return tuple(t.version for t in tables) + (datetime.utcnow().date().isoformat(),)
+
+def conditional(version, tables, build):
+    """Tag the response with `version` (of `tables`) and answer a matching If-None-Match with 304."""
+    parts = [str(v) for v in version]
+    if not all(t.shared_versions for t in tables):
+        parts.append(_ETAG_BOOT)
+    parts.append(request.full_path)
+    tag = hashlib.sha1("|".join(parts).encode()).hexdigest()[:20]
+    if request.if_none_match.contains_weak(tag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.make_response(build())
+        if resp.status_code != 200:
+            return resp
+    resp.set_etag(tag, weak=True)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+def versioned(*tables):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return conditional(table_versions(*tables), tables, lambda: fn(*args, **kwargs))
+        return wrapper
+    return decorator
+
+# Concurrent identical reads (same URL, same table versions) share one
+# computation instead of each scanning the tables.
+_READS = SingleFlight()
+
+def coalesced(tables, build):
+    """build() once for all concurrent requests for this URL at this data version."""
+    return _READS.do((request.full_path, table_versions(*tables)), build)
+
+def patient_versioned(fn):
+    """
+    ETags for the per-patient endpoints: the tag comes from the digest of the
+    patient's cached view (so writes for other patients don't change it), and
+    the handler is given that same view as `view`, so tag and body always match.
+    """
+    @wraps(fn)
+    def wrapper(patient_id):
+        view, etag = patient_snapshot(patient_id)
+        # no table versions in the tag, so no boot id is needed either
+        return conditional((etag, datetime.utcnow().date().isoformat()), (), lambda: fn(patient_id, view))
+    return wrapper
+
+def list_response(rows, next_cursor=None):
+    """rows is a DataFrame or a list of dicts."""
+    if request.args.get('format', '').strip().lower() == 'columnar':
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+        names = [f for f in fields if f in df.columns] if fields else list(df.columns)
+        resp = jsonify({
+            "count": len(df),
+            "fields": names,
+            "columns": {name: df[name].tolist() for name in names},
+        })
+    else:
+        if isinstance(rows, pd.DataFrame):
+            rows = rows.to_dict(orient="records")
+        resp = jsonify(project(rows))
+    if next_cursor is not None:
+        resp.headers['X-Next-Cursor'] = next_cursor
+    return resp
+
 def build_confirm_link(alert_id, user_type):
     params = {'alert_id': alert_id, 'user': user_type}
     return f"{SITE_BASE.rstrip('/')}/api/resolve_alert?{urlencode(params)}"
@@ -159,39 +275,115 @@ def compose_alert_emails(alert_row):
             out.append((to, subj, body, html))
     return out
 
-def run_alerts_and_send(days_threshold=15, low_stock_threshold=5):
+# confirm-link label per recipient role (same wording as the single-alert emails)
+DIGEST_LINK_TEXT = {'chemist': "Mark removed", 'patient': "I have discarded it", 'admin': "Mark resolved"}
+
+def compose_digest_emails(alert_rows):
+    """
+    Group a run's alerts by recipient: one email per recipient listing every
+    alert they would have been mailed about, each with its own confirm link.
+    Returns [(to, subject, body, html), ...] like compose_alert_emails.
+    """
+    digests = {}
+    for alert in alert_rows:
+        product = alert.get('product_name', '')
+        batch = alert.get('batch', '')
+        recipients = [(PHARMACY_EMAIL, 'chemist', None)]
+        for p in find_patients_for_med(product, batch):
+            recipients.append(((p.get('email') or p.get('contact') or "").strip(), 'patient', p.get('name', 'Patient')))
+        if SITE_ADMIN_EMAIL:
+            recipients.append((SITE_ADMIN_EMAIL, 'admin', None))
+
+        for to, role, name in recipients:
+            if not to:
+                continue
+            d = digests.setdefault(to, {'name': name, 'items': {}})
+            # one entry per alert per recipient, first role wins (as in compose_alert_emails)
+            if alert['alert_id'] not in d['items']:
+                d['items'][alert['alert_id']] = (alert, role)
+
+    out = []
+    for to, d in digests.items():
+        lines, items = [], []
+        for alert_id, (alert, role) in d['items'].items():
+            link = build_confirm_link(alert_id, role)
+            product, batch = alert.get('product_name', ''), alert.get('batch', '')
+            exp, days, alert_type = alert.get('exp', ''), alert.get('days_to_expiry', ''), alert.get('alert_type', '')
+            lines.append(f"- {product} (Batch {batch}) — {alert_type}. Expiry: {exp} ({days} days). {DIGEST_LINK_TEXT[role]}: {link}")
+            items.append(f"<li><strong>{product}</strong> (Batch {batch}) — <strong>{alert_type}</strong>. Expiry: {exp} ({days} days). <a href='{link}'>{DIGEST_LINK_TEXT[role]}</a></li>")
+        greeting = f"Dear {d['name']}," if d['name'] else "LifeTag alerts:"
+        subj = f"⚠️ LifeTag alert digest — {len(lines)} alert{'s' if len(lines) != 1 else ''}"
+        body = greeting + "\n\n" + "\n".join(lines)
+        html = f"<p>{greeting}</p><ul>{''.join(items)}</ul>"
+        out.append((to, subj, body, html))
+    return out
+
+# one alert run at a time per process: a run evaluates and creates alerts
+# for the stock keys it takes, so overlapping runs could both create the
+# same alert; runs that queue up behind it find the dirty keys already taken
+_ALERT_RUN_LOCK = threading.Lock()
+
+def run_alerts_and_send(days_threshold=15, low_stock_threshold=5, full=False, digest=True):
     """
     Run alert creation for expired/expiring (<= days_threshold) medicines and send emails.
     Default days_threshold is 15 (per your request).
+    Only stock touched since the last run, plus rows whose expiry status is
+    scheduled to change by today, is evaluated; full=True rescans everything.
+    With digest=True (default) each recipient gets one email for the whole run
+    instead of one per alert.
     """
+    with _ALERT_RUN_LOCK:
+        return _run_alerts_and_send(days_threshold, low_stock_threshold, full, digest)
+
+def _run_alerts_and_send(days_threshold, low_stock_threshold, full, digest):
+    keys = take_dirty_stock_keys() | take_due_stock_keys()
+    if not full and not keys:
+        return []
     try:
-        created = check_expiry_and_create_alerts(days_threshold=days_threshold, low_stock_threshold=low_stock_threshold)
+        created = check_expiry_and_create_alerts(days_threshold=days_threshold, low_stock_threshold=low_stock_threshold,
+                                                 keys=None if full else keys)
     except Exception as e:
         app.logger.exception("check_expiry_and_create_alerts failed")
         created = []
 
+    if digest and created:
+        try:
+            for to, subj, body, html in compose_digest_emails(created):
+                send_email(to, subj, body, html)
+            touch_alerts_last_sent(alert.get('alert_id') for alert in created)
+        except Exception:
+            app.logger.exception("Failed to compose/send alert digests")
+        return created
+
+    sent = []
     for alert in created:
         try:
             for to, subj, body, html in compose_alert_emails(alert):
                 send_email(to, subj, body, html)
-            # mark last_sent to avoid duplicate sends
-            try:
-                touch_alert_last_sent(alert.get('alert_id'))
-            except Exception:
-                pass
+            sent.append(alert.get('alert_id'))
         except Exception:
             app.logger.exception("Failed to compose/send emails for alert: %s", alert)
+    # mark last_sent to avoid duplicate sends (one write for the whole run)
+    try:
+        touch_alerts_last_sent(sent)
+    except Exception:
+        app.logger.exception("Failed to mark alerts as sent")
     return created
 
 # ---------------- Scheduler ----------------
 def start_scheduler():
     scheduler = BackgroundScheduler()
-    # run every 24 hours; start immediately on launch as next_run_time
-    scheduler.add_job(lambda: run_alerts_and_send(days_threshold=15, low_stock_threshold=5), 'interval', hours=24, next_run_time=datetime.utcnow())
+    # one full scan on launch builds the expiry schedule; after that the
+    # daily tick only evaluates rows whose expiry status changes that day
+    scheduler.add_job(lambda: run_alerts_and_send(days_threshold=15, low_stock_threshold=5, full=True), 'date')
+    scheduler.add_job(lambda: run_alerts_and_send(days_threshold=15, low_stock_threshold=5), 'cron', hour=0, minute=5, timezone='UTC')
+    # build the medicine search index up front instead of on the first search
+    scheduler.add_job(MEDICINE_INDEX.refresh, 'date')
     scheduler.start()
-    app.logger.info("Background scheduler started for alerts (24h interval).")
+    app.logger.info("Background scheduler started for alerts (daily expiry tick).")
 
 start_scheduler()
+OUTBOX.start()  # resume any mail left queued by a previous run
 
 # ---------------- Upload Bill ----------------
 @app.route("/api/upload_bill", methods=['POST'])
@@ -207,7 +399,6 @@ def upload_bill():
     file.save(dest)
     ext = filename.rsplit(".", 1)[1].lower()
 
-    created = []
     try:
         if ext == "csv":
             # safe read CSV, tolerate weird headers/extra columns
@@ -215,62 +406,48 @@ def upload_bill():
             # normalize header names to lowercase
             df.columns = [c.strip().lower() for c in df.columns]
 
-            for _, r in df.iterrows():
-                # attempt to find product name from common headers
-                prod = ""
-                for c in ['product name', 'product', 'medicine name', 'name', 'item', 'sr', 'description']:
-                    if c in df.columns and str(r.get(c, "")).strip():
-                        prod = r.get(c, "")
-                        break
-
-                # If no product name and batch exists, allow utils.add_or_update_stock to try fill using batch
-                batch = ""
-                for c in ['batch', 'batch no', 'batch number']:
+            def first_present(cols):
+                for c in cols:
                     if c in df.columns:
-                        batch = r.get(c, "")
-                        break
+                        return df[c].astype(str)
+                return pd.Series("", index=df.index)
 
-                exp = ""
-                for c in ['exp', 'exp.', 'expiry', 'expiry date', 'exp date', 'exp_dt']:
+            def first_nonblank(cols):
+                # per row, the first of `cols` that has a value
+                out = pd.Series("", index=df.index)
+                for c in cols:
                     if c in df.columns:
-                        exp = r.get(c, "")
-                        break
-
-                # quantity detection with fallback columns
-                qty = 0
-                for c in ['qty', 'quantity', 'qnty', 'q', 'QTY']:
-                    if c in df.columns and str(r.get(c, "")).strip():
-                        try:
-                            qty = int(float(r.get(c, 0) or 0))
-                        except:
-                            qty = 0
-                        break
-
-                if not prod and not batch:
-                    # nothing meaningful in this row — skip it
-                    continue
-
-                obj = {
-                    "product_name": str(prod).strip(),
-                    "hsn": str(r.get('hsn', "")).strip() if 'hsn' in df.columns else "",
-                    "mrp": str(r.get('mrp', "")).strip() if 'mrp' in df.columns else "",
-                    "batch": str(batch).strip(),
-                    "exp": str(exp).strip(),
-                    "qty": int(qty),
-                    "manufacturer": str(r.get('manufacturer', "")).strip() if 'manufacturer' in df.columns else "",
-                    "rate": str(r.get('rate', "")).strip() if 'rate' in df.columns else "",
-                    "gtin": str(r.get('gtin', "")).strip() if 'gtin' in df.columns else ""
-                }
-                try:
-                    add_or_update_stock(obj)
-                    created.append(obj)
-                except Exception:
-                    app.logger.exception("add_or_update_stock failed for row: %s", obj)
-                    # continue with next row rather than fail whole upload
+                        vals = df[c].astype(str)
+                        out = out.where(out.str.strip() != "", vals)
+                return out
+
+            # attempt to find product name from common headers
+            prod = first_nonblank(['product name', 'product', 'medicine name', 'name', 'item', 'sr', 'description'])
+            # If no product name and batch exists, bulk_add_or_update_stock will try fill using batch
+            batch = first_present(['batch', 'batch no', 'batch number'])
+            exp = first_present(['exp', 'exp.', 'expiry', 'expiry date', 'exp date', 'exp_dt'])
+            # quantity detection with fallback columns
+            qty = pd.to_numeric(first_nonblank(['qty', 'quantity', 'qnty', 'q', 'QTY']).str.strip(), errors='coerce')
+            qty = qty.replace([float('inf'), float('-inf')], 0).fillna(0).astype(int)
+
+            bill = pd.DataFrame({
+                "product_name": prod.str.strip(),
+                "hsn": first_present(['hsn']).str.strip(),
+                "mrp": first_present(['mrp']).str.strip(),
+                "batch": batch.str.strip(),
+                "exp": exp.str.strip(),
+                "qty": qty,
+                "manufacturer": first_present(['manufacturer']).str.strip(),
+                "rate": first_present(['rate']).str.strip(),
+                "gtin": first_present(['gtin']).str.strip(),
+            })
+            # nothing meaningful in a row without product and batch — skip it
+            bill = bill[(bill["product_name"] != "") | (bill["batch"] != "")]
+            bulk_add_or_update_stock(bill)
 
             # after upload we may want to immediately create alerts for newly added stock
             run_alerts_and_send(days_threshold=15, low_stock_threshold=5)
-            return jsonify({"status": "ok", "imported": len(created)})
+            return jsonify({"status": "ok", "imported": len(bill)})
 
         else:
             # OCR path for images (best-effort)
@@ -287,36 +464,46 @@ def upload_bill():
 
 # ---------------- Inventory ----------------
 @app.route("/api/inventory", methods=['GET'])
+@versioned(STOCK_TABLE)
 def inventory():
-    df = read_csv_to_df(MED_STOCK)
-    if df.empty:
-        return jsonify([])
-    from utils import _try_parse_date
-    out = df.to_dict(orient="records")
-    for r in out:
-        exp = str(r.get('exp', '')).strip()
-        r['expired'] = False
+    """
+    Full inventory, or an expiry-ordered slice of it:
+      ?expiring_within=N      items expiring within N days (add include_expired=false to drop expired ones)
+      ?next_to_expire=K       the next K items to expire (not yet expired)
+    Filters: product_name, batch, manufacturer; from/to on last_update.
+    """
+    within = request.args.get('expiring_within', '').strip()
+    next_k = request.args.get('next_to_expire', '').strip()
+    if within or next_k:
         try:
-            if exp:
-                parsed = _try_parse_date(exp)
-                r['days_to_expiry'] = (parsed - datetime.utcnow().date()).days
-                r['expired'] = r['days_to_expiry'] < 0
-            else:
-                r['days_to_expiry'] = None
-        except Exception:
-            r['days_to_expiry'] = None
-    return out
+            within = int(within) if within else None
+            next_k = int(next_k) if next_k else None
+        except ValueError:
+            return jsonify({"error": "expiring_within and next_to_expire must be integers"}), 400
+        include_expired = request.args.get('include_expired', 'false' if within is None else 'true')
+        df = expiring_stock(within, include_expired=include_expired.lower() != 'false', limit=next_k)
+    else:
+        df = read_csv_to_df(MED_STOCK)
+    if df.empty:
+        return list_response(df)
+    df, cursor = paginate(filter_rows(df, ('product_name', 'batch', 'manufacturer'), 'last_update'))
+    return list_response(with_expiry(df), cursor)
 
 # ---------------- Alerts ----------------
 @app.route("/api/alerts", methods=['GET'])
+@versioned(ALERTS_TABLE)
 def alerts():
-    # Create and send any new alerts then return active (unresolved) alerts
-    run_alerts_and_send(days_threshold=15, low_stock_threshold=5)
-    df = read_csv_to_df(ALERTS)
-    if df.empty:
-        return jsonify([])
-    df = df[df['resolved'] != "yes"]
-    return df.to_dict(orient="records")
+    # Read-only: alerts are created by stock changes and the daily job
+    # Filters: alert_type, product_name, batch; from/to on created_at.
+    def page():
+        df = read_csv_to_df(ALERTS)
+        if df.empty:
+            return df, None
+        df = df[df['resolved'] != "yes"]
+        return paginate(filter_rows(df, ('alert_type', 'product_name', 'batch'), 'created_at'))
+
+    df, cursor = coalesced((ALERTS_TABLE,), page)
+    return list_response(df, cursor)
 
 @app.route("/api/resolve_alert", methods=['GET'])
 def resolve_alert():
@@ -339,24 +526,21 @@ def delete_stock():
     if not product_name and not batch:
         return jsonify({"error": "At least product_name or batch required"}), 400
 
-    df = read_csv_to_df(MED_STOCK)
-    if df.empty:
+    if len(STOCK_TABLE) == 0:
         return jsonify({"error": "no stock"}), 400
 
-    df['product_name'] = df['product_name'].astype(str).fillna("")
-    df['batch'] = df['batch'].astype(str).fillna("")
-
     # support deletion by (product+batch) OR batch-only OR product-only
     if product_name and batch:
-        mask = ~((df['product_name'].str.lower() == product_name.lower()) &
-                 (df['batch'].str.lower() == batch.lower()))
+        doomed = STOCK_TABLE.lookup("product_batch", product_name, batch)
     elif batch:
-        mask = ~(df['batch'].str.lower() == batch.lower())
+        doomed = STOCK_TABLE.lookup("batch", batch)
     else:
-        mask = ~(df['product_name'].str.lower() == product_name.lower())
+        df = STOCK_TABLE.frame()
+        doomed = df[df['product_name'].astype(str).str.lower() == product_name.lower()]
 
-    new_df = df[mask]
-    write_df_to_csv(new_df, MED_STOCK)
+    STOCK_TABLE.delete(doomed.index)
+    for _, row in doomed.iterrows():
+        mark_stock_dirty(row["product_name"], row["batch"])
 
     # resolve any outstanding alerts for the removed stock
     try:
@@ -393,11 +577,14 @@ def api_register_patient():
     return jsonify({"status": "ok", "patient_id": pid})
 
 @app.route("/api/patients", methods=['GET'])
+@versioned(PATIENTS_TABLE)
 def api_patients():
+    # Filters: patient_id, gender; from/to on registered_at.
     df = read_csv_to_df(PATIENTS)
     if df.empty:
-        return jsonify([])
-    return df.to_dict(orient="records")
+        return list_response(df)
+    df, cursor = paginate(filter_rows(df, ('patient_id', 'gender'), 'registered_at'))
+    return list_response(df, cursor)
 
 # ---------------- Prescription Handling ----------------
 @app.route("/api/create_prescription", methods=['POST'])
@@ -410,59 +597,116 @@ def api_create_prescription():
     if provided_pid:
         # if front-end provided an ID, ensure no duplicate
         pid = provided_pid
-        existing = read_csv_to_df(PRESCRIPTIONS)
-        if not existing.empty and (existing['prescription_id'] == pid).any():
+        if not PRESCRIPTIONS_TABLE.lookup("prescription_id", pid).empty:
             return jsonify({"error": "prescription_id already exists"}), 400
-        # append row
-        created_at = datetime.utcnow().isoformat()
-        row = {
-            "prescription_id": pid,
-            "patient_id": body['patient_id'],
-            "doctor_name": body['doctor_name'],
-            "pharmacy_id": body.get('pharmacy_id', 'pharmacy_demo'),
-            "medications_json": json.dumps(body['medications']),
-            "created_at": created_at,
-            "qr_path": "",
-            "status": "created"
-        }
-        df = read_csv_to_df(PRESCRIPTIONS)
-        if df.empty:
-            df = pd.DataFrame(columns=list(row.keys()))
-        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-        write_df_to_csv(df, PRESCRIPTIONS)
+        create_prescription(body['patient_id'], body['doctor_name'], body.get('pharmacy_id', 'pharmacy_demo'),
+                            body['medications'], prescription_id=pid)
     else:
         pid = create_prescription(body['patient_id'], body['doctor_name'], body.get('pharmacy_id', 'pharmacy_demo'), body['medications'])
 
-    # generate QR using SITE_BASE so links are correct
-    view_url = f"{SITE_BASE.rstrip('/')}/prescription/{pid}"
-    img = qrcode.make(view_url)
-    out_file = STATIC_QR_DIR / f"{pid}.png"
-    img.save(out_file)
-
-    # update prescriptions.csv qr_path
-    df = read_csv_to_df(PRESCRIPTIONS)
-    if not df.empty and ('prescription_id' in df.columns):
-        mask = df['prescription_id'] == pid
-        if mask.any():
-            df.loc[mask, 'qr_path'] = str(out_file.name)
-            write_df_to_csv(df, PRESCRIPTIONS)
+    # the QR image is rendered when it is first requested (see qr_response)
 
     # create alerts so doctor/chemist views are updated
     run_alerts_and_send(days_threshold=15, low_stock_threshold=5)
 
-    return jsonify({"status": "ok", "prescription_id": pid, "qr_path": f"/static/qr/{out_file.name}"})
+    return jsonify({"status": "ok", "prescription_id": pid, "qr_path": f"/static/qr/{pid}.png"})
+
+MAX_BULK_PRESCRIPTIONS = 500
+
+@app.route("/api/create_prescriptions", methods=['POST'])
+def api_create_prescriptions():
+    """
+    Bulk create: {"prescriptions": [<create_prescription body>, ...]}.
+    All-or-nothing: if any entry is invalid nothing is written and the
+    errors are returned by position. One write per table, one alert run.
+    """
+    body = request.get_json(force=True)
+    entries = body.get('prescriptions') if isinstance(body, dict) else body
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"error": "prescriptions (a non-empty list) required"}), 400
+    if len(entries) > MAX_BULK_PRESCRIPTIONS:
+        return jsonify({"error": f"at most {MAX_BULK_PRESCRIPTIONS} prescriptions per request"}), 400
+
+    errors, seen = [], set()
+    for i, e in enumerate(entries):
+        if not isinstance(e, dict) or 'patient_id' not in e or 'doctor_name' not in e or 'medications' not in e:
+            errors.append({"index": i, "error": "patient_id, doctor_name, medications required"})
+            continue
+        meds = e['medications']
+        if not isinstance(meds, list) or not all(isinstance(m, dict) for m in meds):
+            errors.append({"index": i, "error": "medications must be a list of objects"})
+            continue
+        pid = e.get('prescription_id')
+        if pid is not None and not isinstance(pid, str):
+            errors.append({"index": i, "error": "prescription_id must be a string"})
+            continue
+        if pid and (pid in seen or not PRESCRIPTIONS_TABLE.lookup("prescription_id", pid).empty):
+            errors.append({"index": i, "error": "prescription_id already exists"})
+        seen.add(pid)
+    if errors:
+        return jsonify({"error": "invalid prescriptions", "errors": errors}), 400
+
+    pids = create_prescriptions([{
+        "patient_id": e['patient_id'], "doctor_name": e['doctor_name'],
+        "pharmacy_id": e.get('pharmacy_id', 'pharmacy_demo'), "medications": e['medications'],
+        "prescription_id": e.get('prescription_id'),
+    } for e in entries])
+
+    # batches get printed right away: warm the QR cache off the request thread
+    threading.Thread(target=prerender_qr, args=(pids,), name="qr-prerender", daemon=True).start()
+
+    run_alerts_and_send(days_threshold=15, low_stock_threshold=5)
+
+    return jsonify({"status": "ok", "count": len(pids), "prescriptions": [
+        {"prescription_id": pid, "qr_path": f"/static/qr/{pid}.png"} for pid in pids
+    ]})
 
 @app.route("/api/prescription/<pid>", methods=['GET'])
+@versioned(PRESCRIPTIONS_TABLE, PRESCRIPTION_ITEMS_TABLE)
 def api_get_prescription(pid):
     p = get_prescription(pid)
     if not p:
         return jsonify({"error": "not found"}), 404
     return jsonify(p)
 
+# ---------------- QR images ----------------
+# Rendered on first request and kept in a bounded LRU instead of being
+# written to static/qr at creation. Files already in static/qr (older
+# prescriptions, generate_prescription_qr.py) are still served as they are.
+# ?compact=1 gives a smaller 1-bit PNG; .svg works wherever .png does.
+QR_RENDERER = QRRenderer(max_bytes=int(os.getenv("QR_CACHE_BYTES", str(8 * 1024 * 1024))))
+QR_MAX_AGE = 365 * 24 * 3600
+
+def qr_view_url(pid):
+    # same content the create endpoint used to write to disk
+    return f"{SITE_BASE.rstrip('/')}/prescription/{pid}"
+
+def prerender_qr(pids):
+    try:
+        QR_RENDERER.prerender([qr_view_url(pid) for pid in pids])
+    except Exception:
+        app.logger.exception("QR pre-render failed; codes will be rendered on request")
+
+def qr_response(filename):
+    if (STATIC_QR_DIR / filename).is_file():
+        resp = send_from_directory(str(STATIC_QR_DIR), filename, max_age=QR_MAX_AGE)
+    else:
+        pid, _, fmt = filename.rpartition('.')
+        if fmt not in QR_MIMETYPES or PRESCRIPTIONS_TABLE.lookup("prescription_id", pid).empty:
+            return jsonify({"error": "QR code not found"}), 404
+        compact = request.args.get('compact', '').lower() in ('1', 'true', 'yes')
+        body = QR_RENDERER.render(qr_view_url(pid), fmt, compact)
+        resp = app.response_class(body, mimetype=QR_MIMETYPES[fmt])
+        resp.set_etag(hashlib.sha1(body).hexdigest()[:20])
+        resp.make_conditional(request)
+    # a prescription's QR never changes
+    resp.headers['Cache-Control'] = f'public, max-age={QR_MAX_AGE}, immutable'
+    return resp
+
 # Serve QR using the path your frontend expects (some places expect /qrcodes/)
 @app.route("/qrcodes/<path:filename>")
 def serve_qrcode_alias(filename):
-    return send_from_directory(str(STATIC_QR_DIR), filename)
+    return qr_response(filename)
 
 @app.route("/api/scan_qr", methods=["POST"])
 def scan_qr():
@@ -477,6 +721,7 @@ def scan_qr():
     result = process_qr_scan(pid, pharmacy)
     if "error" in result:
         return jsonify(result), 404
+    run_alerts_and_send(days_threshold=15, low_stock_threshold=5)
     
     # ✅ NEW: Send expiry alerts to patient after dispensing
     try:
@@ -493,7 +738,7 @@ def scan_qr():
 # existing static QR route
 @app.route("/static/qr/<path:filename>")
 def serve_qr(filename):
-    return send_from_directory(str(STATIC_QR_DIR), filename)
+    return qr_response(filename)
 
 @app.route("/api/dispense", methods=["POST"])
 def dispense_prescription():
@@ -501,11 +746,6 @@ def dispense_prescription():
     prescription_id = data.get("prescription_id")
     dispensed_items = data.get("items", [])
 
-    # Load necessary CSVs
-    med_df = pd.read_csv(MED_STOCK)
-    sales_df = pd.read_csv(SALES)
-    prescriptions_df = pd.read_csv(PRESCRIPTIONS)
-
     new_sales = []
 
     for item in dispensed_items:
@@ -515,14 +755,19 @@ def dispense_prescription():
         sold_at = datetime.now().isoformat()
 
         # --- Update stock ---
+        med_df = STOCK_TABLE.lookup("product_batch", product_name, batch)
         med_idx = med_df[
             (med_df["product_name"] == product_name) &
             (med_df["batch"] == batch)
-        ].index
+        ].index if not med_df.empty else med_df.index
 
         if not med_idx.empty:
-            current_qty = med_df.loc[med_idx[0], "qty"]
-            med_df.loc[med_idx[0], "qty"] = max(0, current_qty - qty)
+            try:
+                current_qty = int(float(med_df.loc[med_idx[0], "qty"] or 0))
+            except Exception:
+                current_qty = 0
+            STOCK_TABLE.update([med_idx[0]], {"qty": max(0, current_qty - qty)})
+            mark_stock_dirty(product_name, batch)
         else:
             print(f"⚠️ Batch {batch} not found in stock for {product_name}")
 
@@ -538,10 +783,10 @@ def dispense_prescription():
             "pharmacy_id": "PHARM001"
         })
 
-    # --- Save updated stock & sales ---
-    med_df.to_csv(MED_STOCK, index=False)
-    sales_df = pd.concat([sales_df, pd.DataFrame(new_sales)], ignore_index=True)
-    sales_df.to_csv(SALES, index=False)
+    # --- Save sales ---
+    insert_sales(new_sales)
+    index_dispensed_items(prescription_id, new_sales)
+    run_alerts_and_send(days_threshold=15, low_stock_threshold=5)
 
     # ✅ NEW: Check and send expiry alerts to patient
     alerts_sent = []
@@ -627,311 +872,247 @@ def trigger_expiry_alerts():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _numbers(col):
+    """Parse a string column as numbers: blank -> 0, unparseable -> NaN."""
+    return pd.to_numeric(col.astype(str).str.strip().replace("", "0"), errors="coerce")
+
+ANALYTICS_RANGES = {'week': 7, 'month': 30, 'year': 365}
+ANALYTICS_TABLES = (STOCK_TABLE, SALES_ROLLUPS_TABLE, PATIENTS_TABLE, PRESCRIPTIONS_TABLE)
+# analytics results are served from this cache and recomputed in the
+# background when the tables change or the entry is older than the TTL
+ANALYTICS_CACHE = ResultCache(lambda: table_versions(*ANALYTICS_TABLES),
+                              ttl=int(os.getenv("ANALYTICS_CACHE_TTL", "60")))
+
+def compute_analytics(time_range, pharmacy_id=""):
+    """The /api/analytics payload for one range and (optional) pharmacy."""
+    # Read all CSVs
+    stock_df = read_csv_to_df(MED_STOCK)
+    patients_df = read_csv_to_df(PATIENTS)
+    prescriptions_df = read_csv_to_df(PRESCRIPTIONS)
+    
+    # Calculate metrics
+    total_medicines = len(stock_df) if not stock_df.empty else 0
+    
+    # Expiring medicines
+    expiring_soon = 0
+    expired = 0
+    low_stock_items = 0
+    stock_value = 0
+    
+    if not stock_df.empty:
+        # Check expiry (range lookups on the sorted expiry index)
+        expired = len(expired_stock())
+        expiring_soon = len(expiring_stock(15, include_expired=False))
+
+        # rows whose qty (or mrp) doesn't parse are left out, as before
+        qty = np.trunc(_numbers(stock_df['qty']))
+        mrp = _numbers(stock_df['mrp'])
+        low_stock_items = int((qty < 10).sum())
+        stock_value = float((qty * mrp).sum())
+    
+    # Total patients
+    total_patients = len(patients_df) if not patients_df.empty else 0
+    
+    # Prescriptions dispensed
+    prescriptions_dispensed = 0
+    if not prescriptions_df.empty:
+        prescriptions_dispensed = len(prescriptions_df[prescriptions_df['status'] == 'dispensed'])
+    
+    # Sales in the range, from the day/week/month buckets covering it
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=ANALYTICS_RANGES[time_range] - 1)
+    sales = sales_rollup(cover_range(start, today), pharmacy_id)
+    total_sales = int(sales['count'].sum())
+    revenue = float(sales['revenue'].sum())
+    
+    # Top selling medicines
+    top_medicines = []
+    if not sales.empty:
+        sales_by_product = sales.groupby('product_name').agg({
+            'qty': 'sum',
+            'revenue': 'sum'
+        }).reset_index()
+        sales_by_product = sales_by_product.sort_values('qty', ascending=False).head(5)
+        top_medicines = [
+            {'name': name, 'sales': int(qty), 'revenue': int(rev)}
+            for name, qty, rev in zip(sales_by_product['product_name'], sales_by_product['qty'], sales_by_product['revenue'])
+        ]
+    
+    # Monthly sales (last 6 months, 12 for range=year), by calendar month
+    monthly_sales = []
+    if len(SALES_ROLLUPS_TABLE):
+        months = []
+        month = today.replace(day=1)
+        for _ in range(12 if time_range == 'year' else 6):
+            months.append(month)
+            month = (month - timedelta(days=1)).replace(day=1)
+        months.reverse()
+        monthly = sales_rollup([('month', m.strftime('%Y-%m')) for m in months], pharmacy_id)
+        monthly_counts = monthly.groupby('bucket')['count'].sum().to_dict()
+        for m in months:
+            period = m.strftime('%Y-%m')
+            monthly_sales.append({
+                'month': m.strftime('%b'),
+                'period': period,
+                'sales': int(monthly_counts.get(period, 0))
+            })
+    
+    return {
+        'total_medicines': total_medicines,
+        'expiring_soon': expiring_soon,
+        'expired': expired,
+        'low_stock_items': low_stock_items,
+        'total_sales': total_sales,
+        'total_patients': total_patients,
+        'prescriptions_dispensed': prescriptions_dispensed,
+        'revenue': int(revenue),
+        'stock_value': int(stock_value),
+        'top_medicines': top_medicines,
+        'monthly_sales': monthly_sales
+    }
+
 @app.route("/api/analytics", methods=['GET'])
 def get_analytics():
     """
-    Returns comprehensive analytics data for the dashboard
+    Returns comprehensive analytics data for the dashboard.
+    Sales figures cover ?range= (week, month or year: the last 7, 30 or 365
+    days) and come from the sales rollups; ?pharmacy_id= limits them to one
+    pharmacy. Stock, patient and prescription counts are current totals.
+    Results come from ANALYTICS_CACHE, so they can trail a write by one
+    background refresh.
     """
+    time_range = request.args.get('range', 'month').strip().lower()
+    if time_range not in ANALYTICS_RANGES:
+        raise QueryError("range must be week, month or year")
+    pharmacy_id = request.args.get('pharmacy_id', '').strip().lower()
     try:
-        time_range = request.args.get('range', 'month')  # week, month, year
-        
-        # Read all CSVs
-        stock_df = read_csv_to_df(MED_STOCK)
-        sales_df = read_csv_to_df(SALES)
-        patients_df = read_csv_to_df(PATIENTS)
-        prescriptions_df = read_csv_to_df(PRESCRIPTIONS)
-        
-        # Calculate metrics
-        total_medicines = len(stock_df) if not stock_df.empty else 0
-        
-        # Expiring medicines
-        expiring_soon = 0
-        expired = 0
-        low_stock_items = 0
-        stock_value = 0
-        
-        if not stock_df.empty:
-            from utils import _try_parse_date
-            for _, row in stock_df.iterrows():
-                # Check expiry
-                exp_raw = str(row.get('exp', '')).strip()
-                if exp_raw:
-                    try:
-                        exp_date = _try_parse_date(exp_raw)
-                        days_left = (exp_date - datetime.utcnow().date()).days
-                        if days_left < 0:
-                            expired += 1
-                        elif days_left <= 15:
-                            expiring_soon += 1
-                    except Exception:
-                        pass
-                
-                # Check low stock
-                try:
-                    qty = int(float(row.get('qty', 0) or 0))
-                    if qty < 10:
-                        low_stock_items += 1
-                    
-                    # Calculate stock value
-                    mrp = float(row.get('mrp', 0) or 0)
-                    stock_value += qty * mrp
-                except Exception:
-                    pass
-        
-        # Total patients
-        total_patients = len(patients_df) if not patients_df.empty else 0
-        
-        # Prescriptions dispensed
-        prescriptions_dispensed = 0
-        if not prescriptions_df.empty:
-            prescriptions_dispensed = len(prescriptions_df[prescriptions_df['status'] == 'dispensed'])
-        
-        # Total sales
-        total_sales = len(sales_df) if not sales_df.empty else 0
-        
-        # Calculate revenue
-        revenue = 0
-        if not sales_df.empty:
-            for _, sale in sales_df.iterrows():
-                product_name = sale.get('product_name')
-                batch = sale.get('batch')
-                qty_sold = int(float(sale.get('qty', 0) or 0))
-                
-                # Find product in stock to get MRP
-                if not stock_df.empty:
-                    product = stock_df[
-                        (stock_df['product_name'].str.lower() == str(product_name).lower()) &
-                        (stock_df['batch'] == str(batch))
-                    ]
-                    if not product.empty:
-                        mrp = float(product.iloc[0].get('mrp', 0) or 0)
-                        revenue += qty_sold * mrp
-        
-        # Top selling medicines
-        top_medicines = []
-        if not sales_df.empty:
-            sales_by_product = sales_df.groupby('product_name').agg({
-                'qty': 'sum'
-            }).reset_index()
-            sales_by_product['qty'] = sales_by_product['qty'].astype(int)
-            sales_by_product = sales_by_product.sort_values('qty', ascending=False).head(5)
-            
-            for _, row in sales_by_product.iterrows():
-                product_name = row['product_name']
-                sales_count = int(row['qty'])
-                
-                # Calculate revenue for this product
-                product_revenue = 0
-                if not stock_df.empty:
-                    product = stock_df[stock_df['product_name'].str.lower() == str(product_name).lower()]
-                    if not product.empty:
-                        mrp = float(product.iloc[0].get('mrp', 0) or 0)
-                        product_revenue = sales_count * mrp
-                
-                top_medicines.append({
-                    'name': product_name,
-                    'sales': sales_count,
-                    'revenue': int(product_revenue)
-                })
-        
-        # Monthly sales (last 6 months)
-        monthly_sales = []
-        if not sales_df.empty and 'sold_at' in sales_df.columns:
-            sales_df['sold_at'] = pd.to_datetime(sales_df['sold_at'], errors='coerce')
-            sales_df = sales_df.dropna(subset=['sold_at'])
-            
-            # Group by month
-            sales_df['month'] = sales_df['sold_at'].dt.strftime('%b')
-            monthly_counts = sales_df.groupby('month').size().to_dict()
-            
-            # Last 6 months
-            months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-            current_month = datetime.utcnow().month
-            
-            for i in range(6):
-                month_idx = (current_month - 6 + i) % 12
-                month_name = months[month_idx]
-                monthly_sales.append({
-                    'month': month_name,
-                    'sales': monthly_counts.get(month_name, 0)
-                })
-        
-        return jsonify({
-            'total_medicines': total_medicines,
-            'expiring_soon': expiring_soon,
-            'expired': expired,
-            'low_stock_items': low_stock_items,
-            'total_sales': total_sales,
-            'total_patients': total_patients,
-            'prescriptions_dispensed': prescriptions_dispensed,
-            'revenue': int(revenue),
-            'stock_value': int(stock_value),
-            'top_medicines': top_medicines,
-            'monthly_sales': monthly_sales
-        })
-        
+        result, version = ANALYTICS_CACHE.get(
+            (time_range, pharmacy_id), lambda: compute_analytics(time_range, pharmacy_id))
     except Exception as e:
         app.logger.exception("Analytics endpoint failed")
         return jsonify({'error': str(e)}), 500
-
-# ADD THESE IMPORTS AT THE TOP
-from flask import send_file
-import io
+    # tagged with the version the cached result was computed at, not the
+    # current one, so a stale result is never cached under a fresh ETag
+    return conditional(version, ANALYTICS_TABLES, lambda: jsonify(result))
 
 # ============ NEW ENDPOINTS FOR FLUTTER APP ============
 
 @app.route("/api/prescriptions", methods=['GET'])
+@versioned(PRESCRIPTIONS_TABLE, PRESCRIPTION_ITEMS_TABLE)
 def get_all_prescriptions():
-    """Get all prescriptions (for patient app to filter by patient_id)"""
-    df = read_csv_to_df(PRESCRIPTIONS)
+    """
+    Get all prescriptions.
+    Filters: patient_id, status, pharmacy_id, doctor_name; from/to on created_at.
+    """
+    patient_id = request.args.get('patient_id', '').strip()
+    df = PRESCRIPTIONS_TABLE.lookup("patient_id", patient_id) if patient_id else read_csv_to_df(PRESCRIPTIONS)
     if df.empty:
-        return jsonify([])
-    
-    results = []
-    for _, row in df.iterrows():
-        prescription = row.to_dict()
-        # Parse medications_json if it's a string
-        if 'medications_json' in prescription and prescription['medications_json']:
-            try:
-                prescription['medications'] = json.loads(prescription['medications_json'])
-            except:
-                prescription['medications'] = []
-        results.append(prescription)
+        return list_response(df)
     
-    return jsonify(results)
+    df, cursor = paginate(filter_rows(df, ('status', 'pharmacy_id', 'doctor_name'), 'created_at'))
+    # medications come from prescription_items (only for the rows on this page)
+    return list_response(prescription_records(df), cursor)
 
 @app.route("/api/patient/<patient_id>/prescriptions", methods=['GET'])
-def get_patient_prescriptions(patient_id):
+@patient_versioned
+def get_patient_prescriptions(patient_id, view):
     """Get all prescriptions for a specific patient"""
-    df = read_csv_to_df(PRESCRIPTIONS)
-    if df.empty:
-        return jsonify([])
-    
-    patient_prescriptions = df[df['patient_id'] == patient_id]
-    
-    results = []
-    for _, row in patient_prescriptions.iterrows():
-        prescription = row.to_dict()
-        if 'medications_json' in prescription and prescription['medications_json']:
-            try:
-                prescription['medications'] = json.loads(prescription['medications_json'])
-            except:
-                prescription['medications'] = []
-        results.append(prescription)
-    
-    return jsonify(results)
+    return jsonify(view["prescriptions"])
+
+@app.route("/api/patient/<patient_id>/timeline", methods=['GET'])
+@patient_versioned
+def get_patient_timeline(patient_id, view):
+    """Profile, prescriptions, dispensed items and active alerts in one call (cached per patient)"""
+    if view["patient"] is None:
+        return jsonify({"error": "Patient not found"}), 404
+    return jsonify(view)
 
 @app.route("/api/patient/<patient_id>", methods=['GET'])
-def get_patient_by_id(patient_id):
+@patient_versioned
+def get_patient_by_id(patient_id, view):
     """Get patient details by ID"""
-    df = read_csv_to_df(PATIENTS)
-    if df.empty:
+    if len(PATIENTS_TABLE) == 0:
         return jsonify({"error": "No patients found"}), 404
     
-    patient = df[df['patient_id'] == patient_id]
-    if patient.empty:
+    patient = view["patient"]
+    if patient is None:
         return jsonify({"error": "Patient not found"}), 404
     
-    return jsonify(patient.iloc[0].to_dict())
+    return jsonify(patient)
 
 @app.route("/api/patient/<patient_id>/alerts", methods=['GET'])
-def get_patient_alerts(patient_id):
+@patient_versioned
+def get_patient_alerts(patient_id, view):
     """
     Get alerts relevant to a specific patient based on their prescriptions.
     Checks if any medicine in their prescriptions is expired/expiring.
     """
     try:
-        # Get patient's prescriptions
-        pres_df = read_csv_to_df(PRESCRIPTIONS)
-        if pres_df.empty:
-            return jsonify([])
-        
-        patient_prescriptions = pres_df[pres_df['patient_id'] == patient_id]
-        if patient_prescriptions.empty:
-            return jsonify([])
-        
-        # Collect all medicine batches for this patient
-        patient_batches = set()
-        for _, pres in patient_prescriptions.iterrows():
-            try:
-                meds = json.loads(pres.get('medications_json', '[]'))
-                for med in meds:
-                    batch = med.get('batch', '').strip()
-                    if batch:
-                        patient_batches.add(batch.lower())
-            except:
-                continue
-        
-        # Get alerts for these batches
-        alerts_df = read_csv_to_df(ALERTS)
-        if alerts_df.empty:
-            return jsonify([])
-        
-        # Filter alerts for patient's medicines (unresolved only)
-        patient_alerts = alerts_df[
-            (alerts_df['batch'].str.lower().isin(patient_batches)) &
-            (alerts_df['resolved'] != 'yes')
-        ]
-        
-        return jsonify(patient_alerts.to_dict(orient='records'))
+        # unresolved alerts on the batches in the patient's prescriptions
+        return jsonify(view["alerts"])
     
     except Exception as e:
         app.logger.exception("Error getting patient alerts")
         return jsonify({"error": str(e)}), 500
 
+SEARCH_PAGE_SIZE = 20
+
 @app.route("/api/medicine/search", methods=['GET'])
+@versioned(STOCK_TABLE)
 def search_medicine():
-    """Search medicine by name (for medicine information feature)"""
-    query = request.args.get('q', '').strip().lower()
+    """
+    Search medicine by name, manufacturer, HSN or GTIN (for medicine information feature).
+    Prefix, substring and typo-tolerant matches, best first; SEARCH_PAGE_SIZE
+    results per page unless ?limit= says otherwise.
+    Filters: batch, manufacturer.
+    """
+    query = request.args.get('q', '').strip()
     if not query:
-        return jsonify([])
-    
-    df = read_csv_to_df(MED_STOCK)
-    if df.empty:
-        return jsonify([])
+        return list_response([])
     
-    # Search in product name
-    results = df[df['product_name'].str.lower().str.contains(query, na=False)]
+    filtered = any(request.args.get(f, '').strip() for f in ('batch', 'manufacturer'))
+    if filtered or request.args.get('after', '').strip():
+        results = search_stock(query)
+    else:
+        # only the first page is needed: rank just enough rows to fill it
+        # (one extra tells paginate whether there is a next page)
+        limit = request.args.get('limit', '').strip()
+        try:
+            limit = min(int(limit), MAX_PAGE_SIZE) if limit else SEARCH_PAGE_SIZE
+        except ValueError:
+            raise QueryError("limit and after must be integers")
+        results = search_stock(query, max(limit, 0) + 1)
+    results, cursor = paginate(filter_rows(results, ('batch', 'manufacturer')), default_limit=SEARCH_PAGE_SIZE)
     
-    return jsonify(results.to_dict(orient='records'))
+    return list_response(results, cursor)
 
 @app.route("/api/medicine/<batch>/info", methods=['GET'])
+@versioned(STOCK_TABLE)
 def get_medicine_info(batch):
     """Get detailed information about a specific medicine batch"""
-    df = read_csv_to_df(MED_STOCK)
-    if df.empty:
+    if len(STOCK_TABLE) == 0:
         return jsonify({"error": "No inventory"}), 404
     
-    medicine = df[df['batch'].str.lower() == batch.lower()]
+    medicine = STOCK_TABLE.lookup("batch", batch)
     if medicine.empty:
         return jsonify({"error": "Medicine not found"}), 404
     
     return jsonify(medicine.iloc[0].to_dict())
 
 @app.route("/api/patient/<patient_id>/medicine-history", methods=['GET'])
-def get_patient_medicine_history(patient_id):
+@patient_versioned
+def get_patient_medicine_history(patient_id, view):
     """Get patient's medicine dispensing history"""
     try:
-        # Get patient's prescriptions
-        pres_df = read_csv_to_df(PRESCRIPTIONS)
-        if pres_df.empty:
-            return jsonify([])
-        
-        patient_prescriptions = pres_df[pres_df['patient_id'] == patient_id]
-        
         history = []
-        for _, pres in patient_prescriptions.iterrows():
-            try:
-                meds = json.loads(pres.get('medications_json', '[]'))
-                history.append({
-                    'prescription_id': pres.get('prescription_id'),
-                    'doctor_name': pres.get('doctor_name'),
-                    'created_at': pres.get('created_at'),
-                    'status': pres.get('status'),
-                    'medications': meds
-                })
-            except:
-                continue
+        for pres in view["prescriptions"]:
+            history.append({
+                'prescription_id': pres.get('prescription_id'),
+                'doctor_name': pres.get('doctor_name'),
+                'created_at': pres.get('created_at'),
+                'status': pres.get('status'),
+                'medications': pres['medications']
+            })
         
         return jsonify(history)
     
@@ -952,10 +1133,11 @@ def health_check():
 @app.route("/api/qr/<prescription_id>.png", methods=['GET'])
 def serve_qr_image(prescription_id):
     """Serve QR code image directly"""
-    qr_file = STATIC_QR_DIR / f"{prescription_id}.png"
-    if qr_file.exists():
-        return send_file(str(qr_file), mimetype='image/png')
-    return jsonify({"error": "QR code not found"}), 404
+    return qr_response(f"{prescription_id}.png")
+
+@app.route("/api/qr/<prescription_id>.svg", methods=['GET'])
+def serve_qr_svg(prescription_id):
+    return qr_response(f"{prescription_id}.svg")
 
 if __name__ == "__main__":
     app.run(host=HOST, port=PORT, debug=True)
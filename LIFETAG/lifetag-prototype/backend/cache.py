@@ -0,0 +1,181 @@
+# backend/cache.py
+"""
+Result caching and request coalescing for expensive reads.
+
+SingleFlight runs a computation once per key at a time: callers that ask
+for a key while it is being computed wait and share that result.
+
+LRUBytes is a size-bounded LRU for rendered blobs (QR images).
+
+A ResultCache keeps the last good result per key together with the data
+version it was computed at (any hashable, e.g. a tuple of table versions).
+When the version has moved on or the entry is older than `ttl` seconds,
+callers still get the cached result straight away and one background
+thread recomputes it. Only a key that has never been computed is built in
+the caller's thread, and concurrent callers for that key wait for the
+single computation instead of starting their own (via SingleFlight).
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class _Call:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Return fn() — or, if a call for `key` is already running, wait for it
+        and return its result (its exception is raised in every caller).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Entry:
+    __slots__ = ("result", "computed_at", "refreshing")
+
+    def __init__(self):
+        self.result = None  # (value, version), replaced as a whole
+        self.computed_at = None
+        self.refreshing = False
+
+
+class ResultCache:
+    """
+    `version` is a zero-argument callable returning the current data
+    version; it should be cheap (table versions are a stat() or one query).
+    At most `max_entries` keys are kept, least recently used first out.
+    """
+
+    def __init__(self, version, ttl=60, max_entries=64):
+        self.version = version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def get(self, key, compute):
+        """Return (value, version it was computed at) for `key`."""
+        entry = self._entry(key)
+        if entry.computed_at is None:
+            self._flight.do(key, lambda: self._fill(entry, compute, only_if_empty=True))
+            return entry.result
+
+        if self._stale(entry):
+            self._refresh_in_background(key, entry, compute)
+        return entry.result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _stale(self, entry):
+        return (time.monotonic() - entry.computed_at > self.ttl
+                or entry.result[1] != self.version())
+
+    def _fill(self, entry, compute, only_if_empty=False):
+        if only_if_empty and entry.computed_at is not None:
+            # filled by a call that finished just before ours started
+            return
+        # read the version first: a write landing mid-computation then
+        # leaves the entry stale rather than looking current
+        version = self.version()
+        value = compute()
+        entry.result, entry.computed_at = (value, version), time.monotonic()
+
+    def _refresh_in_background(self, key, entry, compute):
+        with self._lock:
+            if entry.refreshing:
+                return
+            entry.refreshing = True
+
+        def run():
+            try:
+                self._flight.do(key, lambda: self._fill(entry, compute))
+            except Exception:
+                log.exception("Background refresh of %r failed; keeping the last result", key)
+            finally:
+                with self._lock:
+                    entry.refreshing = False
+
+        threading.Thread(target=run, name="cache-refresh", daemon=True).start()
+
+
+class LRUBytes:
+    """Least-recently-used cache of byte strings holding at most `max_bytes` in total."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
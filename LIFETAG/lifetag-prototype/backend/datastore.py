@@ -0,0 +1,799 @@
+# backend/datastore.py
+"""
+Table storage backends for the data in uploads/.
+
+Table (the default "csv" backend) is a process-resident store for the CSV
+files. Each table is parsed once and kept in memory as a DataFrame of strings.
+Reads are served from memory (with hash indexes for the common lookups) and
+every mutation is written through to the CSV file, so the files on disk stay
+the source of truth. If a file is changed behind our back (e.g. by
+generate_prescription_qr.py) it is reloaded on the next access.
+
+SqliteTable (the "sqlite" backend) keeps the same interface on top of one
+SQLite database in WAL mode, so single-row changes don't rewrite a whole file
+and several worker processes can share the data. On first use each table is
+migrated once from its CSV file.
+
+Both expose `version`, a number that goes up whenever the table's data
+changes (through this process or behind its back), so readers can tell
+whether anything changed without loading a row, and `foreign_version`, which
+only moves for changes this process didn't make itself.
+"""
+import csv
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def _cell(value):
+    """Store every value the way it would come back from pd.read_csv(dtype=str)."""
+    if value is None:
+        return ""
+    try:
+        if pd.isna(value):
+            return ""
+    except (TypeError, ValueError):
+        pass
+    return str(value)
+
+
+def _total(old, value, digits):
+    """old (a stored cell, '' counts as 0) + value, as an int or rounded to `digits` places."""
+    try:
+        old = float(str(old).strip() or 0)
+    except ValueError:
+        old = 0.0
+    total = old + float(value)
+    return int(total) if digits == 0 else round(total, digits)
+
+
+def _read_csv(path):
+    path = Path(path)
+    if path.exists() and path.stat().st_size > 0:
+        try:
+            return pd.read_csv(path, dtype=str).fillna("")
+        except Exception:
+            return pd.read_csv(path).fillna("")
+    return pd.DataFrame()
+
+
+class Table:
+    """
+    One CSV-backed table.
+
+    `indexes` maps an index name to the tuple of columns it is keyed on.
+    Index names listed in `casefold` compare keys case-insensitively.
+    Columns in `sorted_on` get an ordered index for range() queries.
+    Frames handed out are copies whose index labels are stable row ids that
+    can be passed back to update()/delete().
+    `version` is per process (it counts the writes and reloads this process saw).
+    """
+
+    shared_versions = False
+
+    def __init__(self, name, path, columns, indexes=None, casefold=(), sorted_on=()):
+        self.name = name
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.indexes = dict(indexes or {})
+        self.casefold = set(casefold)
+        self.sorted_on = tuple(sorted_on)
+        self._lock = threading.RLock()
+        self._df = None
+        self._pending = []  # (row id, row dict) appended to the file but not yet to _df
+        self._stamp = None
+        self._index_maps = {}
+        self._sorted_maps = {}
+        self._next_id = 0
+        self._version = 0
+        self._own_writes = 0
+        self._seen_stamp = None
+
+    # ---------------- loading ----------------
+
+    def _note_stamp(self, stamp, own=False):
+        """Bump the version the first time a new file stamp is seen (`own`: from our write)."""
+        if stamp != self._seen_stamp:
+            self._seen_stamp = stamp
+            self._version += 1
+            self._own_writes += own
+
+    @property
+    def version(self):
+        """Data version; a stat() of the file, the data itself isn't loaded."""
+        with self._lock:
+            self._note_stamp(self._file_stamp())
+            return self._version
+
+    @property
+    def foreign_version(self):
+        """Like `version`, but only counting changes made behind our back."""
+        with self._lock:
+            return self.version - self._own_writes
+
+    def _file_stamp(self):
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load(self):
+        df = self._current()
+        if self._pending:
+            self._materialize()
+            df = self._df
+        return df
+
+    def _current(self):
+        """The frame as loaded, (re)reading the file if it changed; buffered inserts not included."""
+        stamp = self._file_stamp()
+        if self._df is not None and stamp == self._stamp:
+            return self._df
+        self._pending = []
+        df = _read_csv(self.path)
+        df = df.astype(str) if not df.empty else df
+        df.index = pd.RangeIndex(len(df))
+        self._df = df
+        self._stamp = stamp
+        self._note_stamp(stamp)
+        self._index_maps = {}
+        self._sorted_maps = {}
+        self._next_id = len(df)
+        return df
+
+    def _materialize(self):
+        """Concatenate the buffered inserts onto the frame (once per batch of reads)."""
+        labels = [label for label, _ in self._pending]
+        rows = [row for _, row in self._pending]
+        new = pd.DataFrame.from_records(rows, index=labels, columns=list(self._df.columns)).fillna("")
+        self._df = pd.concat([self._df, new]) if len(self._df) else new
+        self._pending = []
+
+    def _flush(self):
+        """Write the in-memory frame back to disk (atomically)."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        self._df.to_csv(tmp, index=False)
+        os.replace(tmp, self.path)
+        self._stamp = self._file_stamp()
+        self._note_stamp(self._stamp, own=True)
+
+    def _file_header(self):
+        try:
+            with open(self.path, newline="", encoding="utf-8") as f:
+                return next(csv.reader(f), None)
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+
+    def _append(self, rows):
+        """
+        Append just the given row dicts to the CSV instead of rewriting it.
+        Only safe when the file still has exactly our columns; returns False
+        (caller does a full rewrite) if the schema changed or the file moved on.
+        """
+        columns = list(self._df.columns)
+        if self._file_stamp() != self._stamp or self._file_header() != columns:
+            return False
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) not in (b"\n", b"\r")
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            if needs_newline:
+                f.write(os.linesep)
+            writer = csv.writer(f, lineterminator=os.linesep)
+            for row in rows:
+                writer.writerow([row.get(c, "") for c in columns])
+        self._stamp = self._file_stamp()
+        self._note_stamp(self._stamp, own=True)
+        return True
+
+    def reload(self):
+        with self._lock:
+            self._df = None
+            self._pending = []
+            return self._load()
+
+    # ---------------- indexes ----------------
+
+    def _key(self, index, values):
+        fold = index in self.casefold
+        return tuple(str(v).strip().lower() if fold else str(v).strip() for v in values)
+
+    def _index(self, index):
+        idx = self._index_maps.get(index)
+        if idx is not None:
+            return idx
+        cols = self.indexes[index]
+        df = self._df
+        idx = {}
+        if not df.empty and all(c in df.columns for c in cols):
+            for label, *vals in zip(df.index, *(df[c] for c in cols)):
+                idx.setdefault(self._key(index, vals), []).append(label)
+        self._index_maps[index] = idx
+        return idx
+
+    def _sorted(self, col):
+        """(sorted non-blank values, row ids in that order) for a sorted_on column."""
+        got = self._sorted_maps.get(col)
+        if got is not None:
+            return got
+        if col not in self.sorted_on:
+            raise KeyError(f"{self.name} has no sorted index on {col}")
+        df = self._df
+        if col in df.columns and not df.empty:
+            vals = df[col].astype(str)
+            vals = vals[vals != ""]
+            keys = vals.to_numpy(dtype=str)
+            order = np.argsort(keys, kind="stable")
+            got = (keys[order], vals.index.to_numpy()[order])
+        else:
+            got = (np.array([], dtype=str), np.array([], dtype=int))
+        self._sorted_maps[col] = got
+        return got
+
+    def _index_rows(self, labels, rows):
+        """Add freshly inserted rows to any index that is already built."""
+        for index, idx in self._index_maps.items():
+            cols = self.indexes[index]
+            for label, row in zip(labels, rows):
+                vals = [row.get(c, "") for c in cols]
+                idx.setdefault(self._key(index, vals), []).append(label)
+
+    # ---------------- reads ----------------
+
+    def frame(self):
+        """Whole table as a DataFrame copy (empty DataFrame if the file has no rows)."""
+        with self._lock:
+            return self._load().copy()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._current()) + len(self._pending)
+
+    def lookup(self, index, *key):
+        """Rows whose index columns equal `key` (an O(1) hash lookup)."""
+        with self._lock:
+            df = self._load()
+            labels = self._index(index).get(self._key(index, key))
+            if not labels:
+                return df.iloc[0:0].copy()
+            return df.loc[labels].copy()
+
+    def first(self, index, *key):
+        """First matching row as a dict, or None."""
+        rows = self.lookup(index, *key)
+        if rows.empty:
+            return None
+        return rows.iloc[0].to_dict()
+
+    def range(self, col, lo=None, hi=None, limit=None):
+        """
+        Rows with lo <= col <= hi (string order, blanks excluded), ordered by
+        col. A binary search on the sorted index rather than a scan.
+        """
+        with self._lock:
+            df = self._load()
+            keys, labels = self._sorted(col)
+            start = 0 if lo is None else int(np.searchsorted(keys, str(lo), "left"))
+            end = len(keys) if hi is None else int(np.searchsorted(keys, str(hi), "right"))
+            sel = labels[start:end]
+            if limit is not None:
+                sel = sel[:limit]
+            return df.loc[sel].copy()
+
+    # ---------------- writes ----------------
+
+    def insert(self, rows):
+        """
+        Append one or more row dicts. Returns the new row ids.
+        Rows are appended to the end of the CSV; the file is only rewritten
+        when the rows bring new columns (or the header no longer matches).
+        """
+        if isinstance(rows, dict):
+            rows = [rows]
+        return self.apply(inserts=rows)
+
+    def apply(self, updates=(), inserts=()):
+        """
+        Apply per-row updates (`(row_id, values)` pairs) and inserts under one
+        lock with a single write to disk. Returns the new row ids.
+        Plain inserts (no updates, no new columns) are only appended to the
+        file and buffered; they join the in-memory frame on the next read, so
+        a run of single-row inserts doesn't copy the whole table each time.
+        """
+        updates = [(r, vals) for r, vals in updates if vals]
+        inserts = [{k: _cell(v) for k, v in r.items()} for r in inserts]
+        if not updates and not inserts:
+            return []
+        with self._lock:
+            df = self._load() if updates else self._current()
+            updated = 0
+            for row_id, vals in updates:
+                if row_id not in df.index:
+                    continue
+                for col, val in vals.items():
+                    if col not in df.columns:
+                        df[col] = ""
+                    df.at[row_id, col] = _cell(val)
+                updated += 1
+            if updated and any(c in cols for cols in self.indexes.values() for _, v in updates for c in v):
+                self._index_maps = {}
+            if updated and any(c in self.sorted_on for _, v in updates for c in v):
+                self._sorted_maps = {}
+
+            labels = []
+            schema_changed = False
+            if inserts:
+                if df.empty and len(df.columns) == 0:
+                    df = self._df = pd.DataFrame(columns=self.columns)
+                schema_changed = any(k not in df.columns for r in inserts for k in r)
+                labels = list(range(self._next_id, self._next_id + len(inserts)))
+                self._next_id += len(inserts)
+                self._index_rows(labels, inserts)
+                self._sorted_maps = {}
+                if updated or schema_changed:
+                    if self._pending:
+                        self._materialize()
+                        df = self._df
+                    new = pd.DataFrame(inserts, index=labels)
+                    self._df = pd.concat([df, new], ignore_index=False).fillna("")
+                else:
+                    self._pending.extend(zip(labels, inserts))
+                    if not self._append(inserts):
+                        self._materialize()
+                        self._flush()
+                    return labels
+
+            if updated or schema_changed:
+                self._flush()
+            return labels
+
+    def update(self, row_ids, values):
+        """Set columns (`values` dict) on the given row ids."""
+        row_ids = list(row_ids)
+        if not row_ids:
+            return 0
+        with self._lock:
+            df = self._load()
+            row_ids = [r for r in row_ids if r in df.index]
+            if not row_ids:
+                return 0
+            for col, val in values.items():
+                if col not in df.columns:
+                    df[col] = ""
+                df.loc[row_ids, col] = _cell(val)
+            if any(c in cols for cols in self.indexes.values() for c in values):
+                self._index_maps = {}
+            if any(c in self.sorted_on for c in values):
+                self._sorted_maps = {}
+            self._flush()
+            return len(row_ids)
+
+    def update_where(self, row_ids, where, values):
+        """
+        Like update(), but only for those of `row_ids` whose columns still
+        equal `where` (a dict). Returns how many rows were changed, so a
+        caller can claim a row: update_where([id], {"status": "pending"},
+        {"status": "sending"}) == 1 means the row is ours.
+        """
+        with self._lock:
+            df = self._load()
+            row_ids = [r for r in row_ids if r in df.index
+                       and all(c in df.columns and df.at[r, c] == _cell(v) for c, v in where.items())]
+            return self.update(row_ids, values)
+
+    def accumulate(self, index, rows, sums):
+        """
+        Add rows into running totals keyed on `index`: for each row dict, the
+        `sums` columns ({col: decimal places}) are added to the row with the
+        same key, or the row is inserted if there is none. One write.
+        """
+        with self._lock:
+            updates, inserts = [], []
+            for r in rows:
+                found = self.lookup(index, *(r[c] for c in self.indexes[index]))
+                if found.empty:
+                    inserts.append({**r, **{c: _total(0, r[c], d) for c, d in sums.items()}})
+                else:
+                    old = found.iloc[0]
+                    updates.append((found.index[0], {c: _total(old.get(c, ""), r[c], d) for c, d in sums.items()}))
+            return self.apply(updates, inserts)
+
+    def delete(self, row_ids):
+        row_ids = list(row_ids)
+        with self._lock:
+            df = self._load()
+            row_ids = [r for r in row_ids if r in df.index]
+            if not row_ids:
+                return 0
+            self._df = df.drop(index=row_ids)
+            self._index_maps = {}
+            self._sorted_maps = {}
+            self._flush()
+            return len(row_ids)
+
+    def replace(self, df):
+        """Replace the whole table (used by write_df_to_csv)."""
+        df = df.where(pd.notnull(df), "")
+        df = df.astype(str) if not df.empty else df
+        with self._lock:
+            df = df.reset_index(drop=True)
+            self._df = df
+            self._pending = []
+            self._next_id = len(df)
+            self._index_maps = {}
+            self._sorted_maps = {}
+            self._flush()
+
+
+class SqliteTable:
+    """
+    One table in a shared SQLite database, with the same interface as Table.
+
+    All columns are TEXT so values round-trip exactly like the CSV backend.
+    Index keys are trimmed (and lower-cased for `casefold` indexes); the
+    matching expression indexes are created so lookups never scan the table.
+    Row ids are SQLite rowids.
+    `version` is kept in the database (table _versions), bumped in the same
+    transaction as each write, so it is shared by every process using the db.
+    """
+
+    shared_versions = True
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+    def __init__(self, name, path, columns, indexes=None, casefold=(), sorted_on=(), db_path=None):
+        self.name = name
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.indexes = dict(indexes or {})
+        self.casefold = set(casefold)
+        self.sorted_on = tuple(sorted_on)
+        self.db_path = Path(db_path or self.path.parent / "lifetag.db")
+        self._conn, self._lock = self._connect(self.db_path)
+        self._own_writes = 0    # versions bumped by our committed writes
+        self._uncommitted = 0   # ... and by the open transaction
+        with self._lock:
+            if not self._table_columns():
+                self._create()
+                self.migrate_from_csv()
+
+    @classmethod
+    def _connect(cls, db_path):
+        # one connection (and lock) per database file per process; other worker
+        # processes open their own and WAL lets their reads run during our writes
+        key = str(Path(db_path).resolve())
+        with cls._connections_lock:
+            if key not in cls._connections:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                conn = sqlite3.connect(key, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.execute("PRAGMA busy_timeout=5000")
+                conn.execute("CREATE TABLE IF NOT EXISTS _versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+                cls._connections[key] = (conn, threading.RLock())
+            return cls._connections[key]
+
+    # ---------------- schema ----------------
+
+    @staticmethod
+    def _q(ident):
+        return '"' + str(ident).replace('"', '""') + '"'
+
+    def _table_columns(self):
+        rows = self._conn.execute(f"PRAGMA table_info({self._q(self.name)})").fetchall()
+        return [r[1] for r in rows]
+
+    def _bump(self):
+        self._conn.execute(
+            "INSERT INTO _versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1", [self.name])
+        self._uncommitted += 1
+
+    def _commit(self):
+        self._conn.execute("COMMIT")
+        self._own_writes += self._uncommitted
+        self._uncommitted = 0
+
+    def _rollback(self):
+        self._rollback()
+        self._uncommitted = 0
+
+    @property
+    def version(self):
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM _versions WHERE name = ?", [self.name]).fetchone()
+            return row[0] if row else 0
+
+    @property
+    def foreign_version(self):
+        """Like `version`, but only counting writes committed by other processes."""
+        with self._lock:
+            return self.version - self._own_writes
+
+    def _expr(self, index, col):
+        expr = f"trim({self._q(col)})"
+        return f"lower({expr})" if index in self.casefold else expr
+
+    def _create(self, columns=None):
+        cols = ", ".join(f"{self._q(c)} TEXT NOT NULL DEFAULT ''" for c in (columns or self.columns))
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self._q(self.name)} ({cols})")
+        self._create_indexes()
+
+    def _create_indexes(self):
+        existing = set(self._table_columns())
+        for index, cols in self.indexes.items():
+            if not all(c in existing for c in cols):
+                continue
+            exprs = ", ".join(self._expr(index, c) for c in cols)
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self._q(f'ix_{self.name}_{index}')} "
+                f"ON {self._q(self.name)} ({exprs})"
+            )
+        for col in self.sorted_on:
+            if col in existing:
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {self._q(f'ix_{self.name}_{col}_sorted')} "
+                    f"ON {self._q(self.name)} ({self._q(col)})"
+                )
+
+    def _ensure_columns(self, columns):
+        existing = self._table_columns()
+        added = False
+        for c in columns:
+            if c not in existing:
+                self._conn.execute(f"ALTER TABLE {self._q(self.name)} ADD COLUMN {self._q(c)} TEXT NOT NULL DEFAULT ''")
+                existing.append(c)
+                added = True
+        if added:
+            self._create_indexes()
+
+    def migrate_from_csv(self, path=None):
+        """One-shot import of the table's CSV file. Returns the number of rows copied."""
+        df = _read_csv(path or self.path)
+        if len(df.columns) == 0:
+            return 0
+        with self._lock:
+            self._ensure_columns(list(df.columns))
+            rows = df.astype(str).to_dict(orient="records")
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._insert_rows(rows)
+                self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+        return len(rows)
+
+    # ---------------- reads ----------------
+
+    def _select(self, where="", params=()):
+        cur = self._conn.execute(f"SELECT rowid, * FROM {self._q(self.name)} {where}", params)
+        cols = [d[0] for d in cur.description]
+        df = pd.DataFrame.from_records(cur.fetchall(), columns=cols).set_index("rowid")
+        df.index.name = None
+        return df.fillna("")
+
+    def frame(self):
+        with self._lock:
+            return self._select()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT count(*) FROM {self._q(self.name)}").fetchone()[0]
+
+    def lookup(self, index, *key):
+        cols = self.indexes[index]
+        fold = index in self.casefold
+        where = " AND ".join(f"{self._expr(index, c)} = ?" for c in cols)
+        params = [str(v).strip().lower() if fold else str(v).strip() for v in key]
+        with self._lock:
+            if not all(c in self._table_columns() for c in cols):
+                return self._select("WHERE 0")
+            return self._select(f"WHERE {where} ORDER BY rowid", params)
+
+    def first(self, index, *key):
+        rows = self.lookup(index, *key)
+        if rows.empty:
+            return None
+        return rows.iloc[0].to_dict()
+
+    def range(self, col, lo=None, hi=None, limit=None):
+        if col not in self.sorted_on:
+            raise KeyError(f"{self.name} has no sorted index on {col}")
+        with self._lock:
+            if col not in self._table_columns():
+                return self._select("WHERE 0")
+            where, params = [f"{self._q(col)} != ''"], []
+            if lo is not None:
+                where.append(f"{self._q(col)} >= ?")
+                params.append(str(lo))
+            if hi is not None:
+                where.append(f"{self._q(col)} <= ?")
+                params.append(str(hi))
+            sql = f"WHERE {' AND '.join(where)} ORDER BY {self._q(col)}, rowid"
+            if limit is not None:
+                sql += " LIMIT ?"
+                params.append(int(limit))
+            return self._select(sql, params)
+
+    # ---------------- writes ----------------
+
+    def _insert_rows(self, rows):
+        labels = []
+        for r in rows:
+            cols = list(r.keys())
+            sql = (f"INSERT INTO {self._q(self.name)} ({', '.join(self._q(c) for c in cols)}) "
+                   f"VALUES ({', '.join('?' for _ in cols)})")
+            labels.append(self._conn.execute(sql, [r[c] for c in cols]).lastrowid)
+        return labels
+
+    def insert(self, rows):
+        if isinstance(rows, dict):
+            rows = [rows]
+        return self.apply(inserts=rows)
+
+    def apply(self, updates=(), inserts=()):
+        updates = [(int(r), vals) for r, vals in updates if vals]
+        inserts = [{k: _cell(v) for k, v in r.items()} for r in inserts]
+        if not updates and not inserts:
+            return []
+        with self._lock:
+            self._ensure_columns({c for _, vals in updates for c in vals} | {c for r in inserts for c in r})
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row_id, vals in updates:
+                    sets = ", ".join(f"{self._q(c)} = ?" for c in vals)
+                    self._conn.execute(
+                        f"UPDATE {self._q(self.name)} SET {sets} WHERE rowid = ?",
+                        [_cell(v) for v in vals.values()] + [row_id],
+                    )
+                labels = self._insert_rows(inserts)
+                self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+            return labels
+
+    def update(self, row_ids, values):
+        row_ids = [int(r) for r in row_ids]
+        if not row_ids or not values:
+            return 0
+        with self._lock:
+            self._ensure_columns(list(values))
+            sets = ", ".join(f"{self._q(c)} = ?" for c in values)
+            params = [_cell(v) for v in values.values()]
+            marks = ", ".join("?" for _ in row_ids)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.execute(
+                    f"UPDATE {self._q(self.name)} SET {sets} WHERE rowid IN ({marks})", params + row_ids
+                )
+                self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+            return cur.rowcount
+
+    def update_where(self, row_ids, where, values):
+        """update() guarded by `where` in the same statement, so it is atomic across processes."""
+        row_ids = [int(r) for r in row_ids]
+        if not row_ids or not values:
+            return 0
+        with self._lock:
+            self._ensure_columns(list(values) + list(where))
+            sets = ", ".join(f"{self._q(c)} = ?" for c in values)
+            conds = "".join(f" AND {self._q(c)} = ?" for c in where)
+            marks = ", ".join("?" for _ in row_ids)
+            params = [_cell(v) for v in values.values()] + row_ids + [_cell(v) for v in where.values()]
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.execute(
+                    f"UPDATE {self._q(self.name)} SET {sets} WHERE rowid IN ({marks}){conds}", params
+                )
+                if cur.rowcount:
+                    self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+            return cur.rowcount
+
+    def accumulate(self, index, rows, sums):
+        """accumulate() as one IMMEDIATE transaction, so totals added by other processes aren't lost."""
+        rows = [{k: _cell(v) for k, v in r.items()} for r in rows]
+        if not rows:
+            return []
+        cols = self.indexes[index]
+        fold = index in self.casefold
+        table = self._q(self.name)
+        sets = ", ".join(
+            f"{self._q(c)} = CAST(CAST({self._q(c)} AS REAL) + ? AS INTEGER)" if d == 0
+            else f"{self._q(c)} = round(CAST({self._q(c)} AS REAL) + ?, {int(d)})"
+            for c, d in sums.items()
+        )
+        match = " AND ".join(f"{self._expr(index, c)} = ?" for c in cols)
+        sql = (f"UPDATE {table} SET {sets} WHERE rowid = "
+               f"(SELECT rowid FROM {table} WHERE {match} ORDER BY rowid LIMIT 1)")
+        with self._lock:
+            self._ensure_columns({c for r in rows for c in r})
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                inserts = []
+                for r in rows:
+                    key = [r[c].strip().lower() if fold else r[c].strip() for c in cols]
+                    cur = self._conn.execute(sql, [float(r[c]) for c in sums] + key)
+                    if not cur.rowcount:
+                        inserts.append({**r, **{c: _cell(_total(0, r[c], d)) for c, d in sums.items()}})
+                labels = self._insert_rows(inserts)
+                self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+            return labels
+
+    def delete(self, row_ids):
+        row_ids = [int(r) for r in row_ids]
+        if not row_ids:
+            return 0
+        with self._lock:
+            marks = ", ".join("?" for _ in row_ids)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cur = self._conn.execute(f"DELETE FROM {self._q(self.name)} WHERE rowid IN ({marks})", row_ids)
+                self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+            return cur.rowcount
+
+    def replace(self, df):
+        df = df.where(pd.notnull(df), "")
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(f"DELETE FROM {self._q(self.name)}")
+                self._ensure_columns(list(df.columns))
+                self._insert_rows([{k: _cell(v) for k, v in r.items()} for r in df.to_dict(orient="records")])
+                self._bump()
+            except Exception:
+                self._rollback()
+                raise
+            self._commit()
+
+    def reload(self):
+        return self.frame()
+
+
+BACKENDS = {"csv": Table, "sqlite": SqliteTable}
+
+_REGISTRY = {}
+
+
+def open_table(backend, name, path, columns, indexes=None, casefold=(), sorted_on=(), **options):
+    """Build a table on the named storage backend ("csv" or "sqlite")."""
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"unknown storage backend: {backend}")
+    return cls(name, path, columns, indexes=indexes, casefold=casefold, sorted_on=sorted_on, **options)
+
+
+def register(table):
+    _REGISTRY[str(Path(table.path).resolve())] = table
+    return table
+
+
+def table_for(path):
+    """Registered Table for a CSV path, or None for ad-hoc files (e.g. bills)."""
+    return _REGISTRY.get(str(Path(path).resolve()))
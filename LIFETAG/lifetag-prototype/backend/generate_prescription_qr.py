@@ -3,9 +3,11 @@ import csv
 import json
 import time
 import uuid
-import qrcode
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+from qr import render_qr
+
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 PRESCRIPTION_FILE = os.path.join(UPLOAD_FOLDER, 'prescriptions.csv')
 QR_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'qr')
@@ -13,21 +15,45 @@ QR_FOLDER = os.path.join(os.path.dirname(__file__), 'static', 'qr')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(QR_FOLDER, exist_ok=True)
 
+# batches of at least this many are rendered on a process pool when run as a script
+POOL_MIN_BATCH = 16
+
 def generate_prescription_qr(patient_id, doctor_name, pharmacy_name, medicines):
     """
     Generates a unique prescription ID (starting with RX), saves to CSV,
     and creates a QR code image for it.
     """
-    # Generate unique prescription ID
-    prescription_id = f"RX{int(time.time() * 1000)}"
+    return generate_prescriptions_qr([{
+        "patient_id": patient_id,
+        "doctor_name": doctor_name,
+        "pharmacy_name": pharmacy_name,
+        "medicines": medicines,
+    }])[0]
+
+def _save_qr(job):
+    data, path = job
+    with open(path, "wb") as f:
+        f.write(render_qr(data))
+    return path
+
+def generate_prescriptions_qr(prescriptions, pool=None):
+    """
+    Bulk version of generate_prescription_qr: `prescriptions` is a list of
+    dicts with patient_id, doctor_name, pharmacy_name and medicines. All
+    records are appended to the CSV in one write. The QR images are rendered
+    one by one in the calling thread, or on `pool` (an executor) if given;
+    only the command line passes one, as importers may be threaded (see
+    qr.py). Returns [(prescription_id, qr_path), ...].
+    """
+    # Unique prescription IDs: the current time in ms plus a random suffix per
+    # record, so batches started in the same millisecond can't collide
+    base = int(time.time() * 1000)
+    ids = [f"RX{base}{uuid.uuid4().hex[:8].upper()}" for _ in prescriptions]
 
     timestamp = datetime.now().isoformat()
     status = "created"
 
-    # Convert medicines list to JSON string for CSV
-    medicines_json = json.dumps(medicines, ensure_ascii=False)
-
-    # Save prescription record
+    # Save prescription records
     file_exists = os.path.exists(PRESCRIPTION_FILE)
     with open(PRESCRIPTION_FILE, mode="a", newline="", encoding="utf-8") as csvfile:
         writer = csv.writer(csvfile)
@@ -42,22 +68,39 @@ def generate_prescription_qr(patient_id, doctor_name, pharmacy_name, medicines):
                 "remarks",
                 "status"
             ])
-        writer.writerow([
+        writer.writerows([
             prescription_id,
-            patient_id,
-            doctor_name,
-            pharmacy_name,
-            medicines_json,
+            p["patient_id"],
+            p["doctor_name"],
+            p["pharmacy_name"],
+            # medicines list as a JSON string for CSV
+            json.dumps(p["medicines"], ensure_ascii=False),
             timestamp,
             "",
             status
-        ])
+        ] for prescription_id, p in zip(ids, prescriptions))
+
+    # Generate QR code images
+    jobs = [(json.dumps({"prescription_id": prescription_id}), os.path.join(QR_FOLDER, f"{prescription_id}.png"))
+            for prescription_id in ids]
+    if pool is None:
+        paths = [_save_qr(job) for job in jobs]
+    else:
+        paths = list(pool.map(_save_qr, jobs, chunksize=8))
+
+    for prescription_id, qr_path in zip(ids, paths):
+        print(f"[QR Generated] {prescription_id} → {qr_path}")
+    return list(zip(ids, paths))
 
-    # Generate QR code image
-    qr_data = {"prescription_id": prescription_id}
-    qr = qrcode.make(json.dumps(qr_data))
-    qr_path = os.path.join(QR_FOLDER, f"{prescription_id}.png")
-    qr.save(qr_path)
 
-    print(f"[QR Generated] {prescription_id} → {qr_path}")
-    return prescription_id, qr_path
+if __name__ == "__main__":
+    # python generate_prescription_qr.py batch.json  (a JSON list of prescriptions)
+    import sys
+    with open(sys.argv[1], encoding="utf-8") as f:
+        batch = json.load(f)
+    if len(batch) < POOL_MIN_BATCH:
+        generate_prescriptions_qr(batch)
+    else:
+        # a fresh single-threaded process: safe to fork workers, shut down on exit
+        with ProcessPoolExecutor() as pool:
+            generate_prescriptions_qr(batch, pool=pool)
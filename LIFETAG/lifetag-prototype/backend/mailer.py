@@ -0,0 +1,290 @@
+# backend/mailer.py
+"""
+Background email outbox.
+
+send_email() callers only enqueue: the message is written to a persistent
+outbox table (uploads/email_outbox.csv, or the SQLite db) and handed to a
+small pool of worker threads. Each worker keeps its SMTP session open and
+authenticated between messages instead of connecting and logging in per
+email. Failed sends stay in the table and are retried with exponential
+backoff; messages left over from a previous run are picked up on start().
+Several processes can share one outbox table (the sqlite backend): a worker
+claims a message (status "pending" -> "sending") with a conditional update
+before sending it, so each attempt is made by exactly one of them.
+
+Messages are routed by `channel` to a transport registered with
+add_transport(); transport_from_env() builds one from the SMTP_* variables.
+To try it locally point a transport at a stand-in server, e.g.
+`python -m aiosmtpd -n -l localhost:1025` with starttls=False and no login.
+"""
+import os
+import queue
+import smtplib
+import threading
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+OUTBOX_COLUMNS = ["message_id", "channel", "recipient", "subject", "body", "html",
+                  "status", "attempts", "next_attempt_at", "last_error", "created_at"]
+
+
+class SmtpTransport:
+    """Opens authenticated SMTP sessions (SMTP_SSL, or SMTP with optional STARTTLS)."""
+
+    def __init__(self, host, port, user="", password="", from_email="", ssl=False, starttls=True, timeout=20):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.from_email = from_email or user
+        self.ssl = ssl
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def connect(self):
+        if self.ssl:
+            conn = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.starttls:
+                conn.starttls()
+        if self.user:
+            conn.login(self.user, self.password)
+        return conn
+
+    def send(self, conn, msg):
+        conn.send_message(msg)
+
+    def close(self, conn):
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class ConsoleTransport:
+    """Prints messages instead of sending them (local dev without SMTP)."""
+
+    def __init__(self, from_email="lifetag@example.com"):
+        self.from_email = from_email
+
+    def connect(self):
+        return None
+
+    def send(self, conn, msg):
+        print("---- EMAIL (console) ----")
+        print("To:", msg["To"])
+        print("Subject:", msg["Subject"])
+        for part in msg.walk():
+            if part.get_content_maintype() == "text":
+                print(part.get_content())
+
+    def close(self, conn):
+        pass
+
+
+def transport_from_env(from_email=""):
+    """
+    SmtpTransport for SMTP_HOST / SMTP_PORT / SMTP_USER / SMTP_PASS (port 465
+    means SMTP over SSL; SMTP_STARTTLS=false for a plain local server), or a
+    ConsoleTransport when SMTP isn't configured.
+    """
+    host = os.getenv("SMTP_HOST", "")
+    user = os.getenv("SMTP_USER", "")
+    password = os.getenv("SMTP_PASS", "")
+    starttls = os.getenv("SMTP_STARTTLS", "true").strip().lower() not in ("0", "false", "no")
+    from_email = from_email or os.getenv("FROM_EMAIL") or user or "lifetag@example.com"
+    if not host or not (user and password or not starttls):
+        return ConsoleTransport(from_email)
+    try:
+        port = int(os.getenv("SMTP_PORT") or 587)
+    except ValueError:
+        port = 587
+    return SmtpTransport(host, port, user, password, from_email=from_email,
+                         ssl=port == 465, starttls=starttls and port != 465)
+
+
+class Outbox:
+    """
+    Persistent email queue drained by `workers` threads.
+
+    `table` is a datastore table with OUTBOX_COLUMNS and a "message_id" and
+    "status" index. A message is retried up to `max_attempts` times, waiting
+    backoff * 2**(attempt-1) seconds (capped at max_backoff) between tries,
+    and is then left in the table with status "failed". Sent messages are
+    removed from the table. A claim ("sending") whose holder died is given
+    back to the queue after `claim_timeout` seconds.
+    """
+
+    def __init__(self, table, workers=2, poll_interval=5, max_attempts=6, backoff=30, max_backoff=3600,
+                 claim_timeout=600):
+        self.table = table
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self._transports = {}
+        self._queue = queue.Queue()
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def add_transport(self, channel, transport):
+        self._transports[channel] = transport
+
+    def enqueue(self, recipient, subject, body, html=None, channel="default"):
+        """Persist a message and queue it for delivery; returns its message_id."""
+        message_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        self.table.insert({
+            "message_id": message_id, "channel": channel, "recipient": recipient,
+            "subject": subject, "body": body, "html": html or "", "status": "pending",
+            "attempts": 0, "next_attempt_at": now, "last_error": "", "created_at": now,
+        })
+        self.start()
+        self._submit(message_id)
+        return message_id
+
+    def start(self):
+        """Start the workers and the retry pump (idempotent)."""
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+                             for i in range(self.workers)]
+            self._threads.append(threading.Thread(target=self._pump, name="outbox-pump", daemon=True))
+            for t in self._threads:
+                t.start()
+
+    def stop(self):
+        self._stop.set()
+        for _ in range(self.workers):
+            self._queue.put(None)
+        for t in self._threads:
+            t.join(timeout=self.poll_interval + 1)
+        with self._lock:
+            self._threads = []
+
+    def drain(self):
+        """Block until every queued delivery attempt has finished."""
+        self._queue.join()
+
+    def pending(self):
+        """Messages still waiting to be sent (including scheduled retries)."""
+        return self.table.lookup("status", "pending")
+
+    def _submit(self, message_id):
+        with self._lock:
+            if message_id in self._inflight:
+                return
+            self._inflight.add(message_id)
+        self._queue.put(message_id)
+
+    def _pump(self):
+        # queue retries (and leftovers from a previous run) once they are due
+        while not self._stop.is_set():
+            now = datetime.utcnow().isoformat()
+            self._release_stale_claims(now)
+            due = self.pending()
+            if not due.empty:
+                due = due[(due["next_attempt_at"] <= now) & due["channel"].isin(list(self._transports))]
+                for message_id in due["message_id"]:
+                    self._submit(message_id)
+            self._stop.wait(self.poll_interval)
+
+    def _release_stale_claims(self, now):
+        # claimed by a worker that never finished (its process died mid-send)
+        stuck = self.table.lookup("status", "sending")
+        for row_id, claimed_until in stuck["next_attempt_at"].items() if not stuck.empty else ():
+            if claimed_until <= now:
+                self.table.update_where([row_id], {"status": "sending", "next_attempt_at": claimed_until},
+                                        {"status": "pending"})
+
+    def _worker(self):
+        sessions = {}
+        while True:
+            message_id = self._queue.get()
+            try:
+                if message_id is None:
+                    break
+                self._deliver(message_id, sessions)
+            except Exception as e:
+                print(f"❌ Outbox worker error: {e}")
+            finally:
+                with self._lock:
+                    self._inflight.discard(message_id)
+                self._queue.task_done()
+        for channel, conn in sessions.items():
+            self._transports[channel].close(conn)
+
+    def _deliver(self, message_id, sessions):
+        rows = self.table.lookup("message_id", message_id)
+        if rows.empty or rows.iloc[0]["status"] != "pending":
+            return
+        if rows.iloc[0]["next_attempt_at"] > datetime.utcnow().isoformat():
+            return  # rescheduled (by another worker) since it was queued
+        row_id, row = rows.index[0], rows.iloc[0]
+        transport = self._transports.get(row["channel"])
+        if transport is None:
+            return
+        # claim it; another process may have picked up the same row. The claim
+        # is held until next_attempt_at, then the pump hands the row back.
+        claimed_until = (datetime.utcnow() + timedelta(seconds=self.claim_timeout)).isoformat()
+        if not self.table.update_where([row_id], {"status": "pending", "next_attempt_at": row["next_attempt_at"]},
+                                       {"status": "sending", "next_attempt_at": claimed_until}):
+            return
+
+        msg = EmailMessage()
+        msg["Subject"] = row["subject"]
+        msg["From"] = transport.from_email
+        msg["To"] = row["recipient"]
+        msg.set_content(row["body"])
+        if row["html"]:
+            msg.add_alternative(row["html"], subtype="html")
+
+        try:
+            self._send(row["channel"], transport, msg, sessions)
+        except Exception as e:
+            attempts = int(row["attempts"] or 0) + 1
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            failed = attempts >= self.max_attempts
+            self.table.update([row_id], {
+                "attempts": attempts,
+                "status": "failed" if failed else "pending",
+                "next_attempt_at": (datetime.utcnow() + timedelta(seconds=delay)).isoformat(),
+                "last_error": str(e),
+            })
+            print(f"❌ Email to {row['recipient']} failed (attempt {attempts}): {e}")
+            return
+        self.table.delete([row_id])
+        print(f"✅ Email sent to {row['recipient']}")
+
+    @staticmethod
+    def _send(channel, transport, msg, sessions):
+        conn = sessions.get(channel)
+        if conn is not None:
+            try:
+                transport.send(conn, msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                # the server dropped an idle session — reconnect once below
+                pass
+            except Exception:
+                sessions.pop(channel, None)
+                transport.close(conn)
+                raise
+        sessions[channel] = conn = transport.connect()
+        try:
+            transport.send(conn, msg)
+        except Exception:
+            sessions.pop(channel, None)
+            transport.close(conn)
+            raise
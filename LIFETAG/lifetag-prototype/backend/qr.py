@@ -0,0 +1,66 @@
+# backend/qr.py
+"""
+On-demand QR code rendering.
+
+Prescription QR codes are not written to static/qr when a prescription is
+created; they are rendered the first time they are requested and kept in
+a bounded in-memory LRU (QRRenderer). Concurrent requests for the same
+image share one render.
+
+Formats: "png" (what qrcode.make() produced before), "png" with
+compact=True (smaller modules and border, 1-bit) and "svg".
+
+QRRenderer.prerender() fills the cache for a batch of codes up front
+(bulk prescription creation). It renders in the calling thread; app.py runs
+it on a background thread. Rendering holds the GIL, so more threads don't
+help, and a process pool isn't used in the server: forking a threaded
+process is unsafe and spawned workers would re-import app.py. Only the
+generate_prescription_qr.py command line, a single-threaded process of its
+own, renders on a pool.
+"""
+import io
+
+import qrcode
+import qrcode.image.svg
+
+from cache import LRUBytes, SingleFlight
+
+MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def render_qr(data, fmt="png", compact=False):
+    """Encode `data` as a QR image; returns the file bytes."""
+    if fmt not in MIMETYPES:
+        raise ValueError(f"unsupported QR format: {fmt}")
+    qr = qrcode.QRCode(box_size=4 if compact else 10, border=2 if compact else 4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    out = io.BytesIO()
+    if fmt == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(out)
+    else:
+        qr.make_image().get_image().convert("1").save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+class QRRenderer:
+    """render_qr() behind an LRU of at most `max_bytes` of images."""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self._cache = LRUBytes(max_bytes)
+        self._flight = SingleFlight()
+
+    def render(self, data, fmt="png", compact=False):
+        key = (data, fmt, compact)
+        body = self._cache.get(key)
+        if body is None:
+            body = self._flight.do(key, lambda: render_qr(data, fmt, compact))
+            self._cache.put(key, body)
+        return body
+
+    def prerender(self, datas, fmt="png", compact=False):
+        """Render the codes for `datas` that are not cached yet and cache them."""
+        todo = [d for d in dict.fromkeys(datas) if self._cache.get((d, fmt, compact)) is None]
+        for d in todo:
+            self._cache.put((d, fmt, compact), render_qr(d, fmt, compact))
+        return len(todo)
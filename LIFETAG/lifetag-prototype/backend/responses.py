@@ -0,0 +1,93 @@
+# backend/responses.py
+"""
+Response layer for the API.
+
+FastJSONProvider serializes with orjson when it is installed (Flask's own
+encoder otherwise) and understands DataFrames, Series and NumPy values, so
+handlers can hand them over without converting first. compress_response()
+is an after_request hook that gzips - or brotli-compresses, when the brotli
+package is installed and the client accepts it - larger /api/ responses.
+"""
+import gzip
+
+import numpy as np
+import pandas as pd
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+# responses below this many bytes are sent as they are
+COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE = {"application/json", "image/svg+xml", "text/csv", "text/html", "text/plain"}
+
+
+def _default(obj):
+    """Encoder fallback for the pandas/NumPy values handlers return."""
+    if isinstance(obj, pd.DataFrame):
+        return obj.to_dict(orient="records")
+    if isinstance(obj, pd.Series):
+        return obj.tolist()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is pd.NaT:
+        return None
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (keys sorted, like Flask's default)."""
+
+    default = staticmethod(_default)
+
+    if orjson is not None:
+        _options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+        def dumps(self, obj, **kwargs):
+            if kwargs:
+                return super().dumps(obj, **kwargs)
+            return orjson.dumps(obj, default=_default, option=self._options).decode()
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(
+                orjson.dumps(obj, default=_default, option=self._options), mimetype=self.mimetype
+            )
+
+
+def compress_response(resp):
+    """Compress /api/ responses over COMPRESS_MIN_SIZE for clients that accept it."""
+    if (
+        not request.path.startswith("/api/")
+        or resp.status_code != 200
+        or resp.direct_passthrough
+        or "Content-Encoding" in resp.headers
+        or resp.mimetype not in COMPRESSIBLE
+    ):
+        return resp
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return resp
+    resp.vary.add("Accept-Encoding")
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        resp.set_data(brotli.compress(data, quality=4))
+        resp.headers["Content-Encoding"] = "br"
+    elif accept["gzip"]:
+        resp.set_data(gzip.compress(data, compresslevel=5))
+        resp.headers["Content-Encoding"] = "gzip"
+    return resp
@@ -0,0 +1,283 @@
+# backend/search.py
+"""
+In-memory text search over a datastore table.
+
+Each row's search fields are split into lower-cased alphanumeric tokens
+(mixed ones like "500mg" also as "500" and "mg").
+A query token matches a row token exactly, as a prefix (binary search on
+the sorted token list), or anywhere inside it (trigram index over the
+tokens). A query token that matches nothing that way falls back to the
+row tokens within a small edit distance, so "paracetmol" still finds
+"Paracetamol". Every query token has to match for a row to be returned.
+
+The index follows the table's `version`: when it moves, the rows whose
+search fields changed are re-indexed and the rest are left alone.
+"""
+import bisect
+import heapq
+import re
+import threading
+
+_TOKEN = re.compile(r"[0-9a-z]+")
+_PART = re.compile(r"[0-9]+|[a-z]+")
+
+# points per query token, by how it matched; tokens from the first field
+# (the name) score NAME_BONUS more
+EXACT, PREFIX, INFIX, FUZZY = 4, 3, 2, 1
+NAME_BONUS = 0.5
+
+
+def tokens(text):
+    return _TOKEN.findall(str(text).lower())
+
+
+def index_tokens(text):
+    """tokens() plus the letter and digit runs of mixed tokens ("500mg" -> 500mg, 500, mg)."""
+    out = []
+    for tok in tokens(text):
+        out.append(tok)
+        parts = _PART.findall(tok)
+        if len(parts) > 1:
+            out.extend(parts)
+    return out
+
+
+def _grams(token, padded=False):
+    if padded:
+        token = "^" + token + "$"
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+def _max_edits(token):
+    return 0 if len(token) < 4 else 1 if len(token) < 6 else 2
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance of a and b, or limit + 1 once it is known to exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+
+class SearchIndex:
+    """
+    Token index over `fields` of `table` (the first field is the name).
+    search() returns row ids of the table, best match first: rows whose
+    name starts with the query, then by score, ties by name.
+    """
+
+    # re-sort instead of inserting one by one past this many changes
+    RESORT_AFTER = 64
+
+    def __init__(self, table, fields):
+        self.table = table
+        self.fields = tuple(fields)
+        self._lock = threading.RLock()
+        self._version = None
+        self._frame = None
+        self._fields = None   # search fields of the indexed rows (DataFrame)
+        self._docs = {}       # row id -> (tokens, name)
+        self._postings = {}   # token -> (rows with it in the name, rows with it elsewhere only)
+        self._sorted = []     # all tokens, sorted (prefix lookups)
+        self._grams = {}      # trigram -> tokens containing it
+        self._names = []      # (name, row id), sorted
+        self._order = {}      # row id -> position in _names
+
+    # ---------------- maintenance ----------------
+
+    def refresh(self):
+        """Bring the index up to date with the table (cheap when nothing changed)."""
+        with self._lock:
+            version = self.table.version
+            if version == self._version:
+                return
+            frame = self.table.frame()
+            fields = frame.reindex(columns=list(self.fields), fill_value="").astype(str)
+            prev = self._fields
+            if prev is None:
+                removed, changed = [], fields.index
+            else:
+                # compare column-wise; only rows whose search fields differ are re-indexed
+                removed = prev.index.difference(fields.index)
+                common = fields.index.intersection(prev.index)
+                differs = (fields.loc[common] != prev.loc[common]).any(axis=1)
+                changed = fields.index.difference(prev.index).append(common[differs.to_numpy()])
+            touched, renamed = set(), []
+            for rid in removed:
+                renamed.append(((self._docs[rid][1], rid), None))
+                touched |= self._remove(rid)
+            for rid, *values in fields.loc[changed].itertuples(name=None):
+                old = None
+                if rid in self._docs:
+                    old = (self._docs[rid][1], rid)
+                    touched |= self._remove(rid)
+                touched |= self._add(rid, values)
+                renamed.append((old, (self._docs[rid][1], rid)))
+            self._resort(touched, renamed)
+            self._frame = frame
+            self._fields = fields
+            self._version = version
+
+    def _add(self, rid, values):
+        name_tokens = set(index_tokens(values[0]))
+        other_tokens = {tok for v in values[1:] for tok in index_tokens(v)} - name_tokens
+        self._docs[rid] = (name_tokens | other_tokens, " ".join(tokens(values[0])))
+        new = set()
+        for tok in name_tokens | other_tokens:
+            posting = self._postings.get(tok)
+            if posting is None:
+                posting = self._postings[tok] = (set(), set())
+                new.add(tok)
+                for g in _grams(tok, padded=True):
+                    self._grams.setdefault(g, set()).add(tok)
+            posting[0 if tok in name_tokens else 1].add(rid)
+        return new
+
+    def _remove(self, rid):
+        toks, _ = self._docs.pop(rid)
+        gone = set()
+        for tok in toks:
+            in_name, elsewhere = self._postings[tok]
+            in_name.discard(rid)
+            elsewhere.discard(rid)
+            if not in_name and not elsewhere:
+                del self._postings[tok]
+                gone.add(tok)
+                for g in _grams(tok, padded=True):
+                    toks_with = self._grams.get(g)
+                    if toks_with is not None:
+                        toks_with.discard(tok)
+                        if not toks_with:
+                            del self._grams[g]
+        return gone
+
+    def _resort(self, touched, renamed):
+        if len(touched) > self.RESORT_AFTER:
+            self._sorted = sorted(self._postings)
+        else:
+            for tok in touched:
+                i = bisect.bisect_left(self._sorted, tok)
+                present = i < len(self._sorted) and self._sorted[i] == tok
+                if tok in self._postings and not present:
+                    self._sorted.insert(i, tok)
+                elif tok not in self._postings and present:
+                    del self._sorted[i]
+        if not renamed:
+            return
+        if len(renamed) > self.RESORT_AFTER:
+            self._names = sorted((doc[1], rid) for rid, doc in self._docs.items())
+        else:
+            for old, new in renamed:
+                if old is not None:
+                    i = bisect.bisect_left(self._names, old)
+                    if i < len(self._names) and self._names[i] == old:
+                        del self._names[i]
+                if new is not None:
+                    bisect.insort(self._names, new)
+        self._order = {rid: i for i, (_, rid) in enumerate(self._names)}
+
+    # ---------------- queries ----------------
+
+    def _matches(self, q):
+        """{row token: points} for one query token."""
+        found = {}
+        i = bisect.bisect_left(self._sorted, q)
+        while i < len(self._sorted) and self._sorted[i].startswith(q):
+            tok = self._sorted[i]
+            found[tok] = EXACT if tok == q else PREFIX
+            i += 1
+        if len(q) >= 3:
+            sets = sorted((self._grams.get(g, set()) for g in _grams(q)), key=len)
+            for tok in set.intersection(*sets) if sets and sets[0] else ():
+                if tok not in found and q in tok:
+                    found[tok] = INFIX
+        if not found and _max_edits(q):
+            limit = _max_edits(q)
+            grams = _grams(q, padded=True)
+            shared = {}
+            for g in grams:
+                for tok in self._grams.get(g, ()):
+                    shared[tok] = shared.get(tok, 0) + 1
+            # q-gram lemma: within `limit` edits at least this many trigrams survive
+            need = max(1, len(grams) - 3 * limit)
+            for tok, n in shared.items():
+                if n >= need and edit_distance(q, tok, limit) <= limit:
+                    found[tok] = FUZZY
+        return found
+
+    def _levels(self, q):
+        """[(score, rows)] for one query token, best first; each row only at its best score."""
+        by_points = {}
+        for tok, points in self._matches(q).items():
+            by_points.setdefault(points, []).append(self._postings[tok])
+        levels, seen = [], set()
+        for points in sorted(by_points, reverse=True):
+            postings = by_points[points]
+            for score, rows in ((points + NAME_BONUS, set().union(*(p[0] for p in postings))),
+                                (points, set().union(*(p[1] for p in postings)))):
+                rows -= seen
+                if rows:
+                    levels.append((score, rows))
+                    seen |= rows
+        return levels
+
+    def _leading(self, lead):
+        """Row ids whose name starts with `lead`, in name order."""
+        i = bisect.bisect_left(self._names, (lead,))
+        while i < len(self._names) and self._names[i][0].startswith(lead):
+            yield self._names[i][1]
+            i += 1
+
+    def search(self, query, limit=None):
+        """Row ids matching every token of `query`, best first; at most `limit` of them."""
+        with self._lock:
+            self.refresh()
+            q_tokens = list(dict.fromkeys(tokens(query)))
+            if not q_tokens:
+                return []
+            # rows grouped by total score: combine the tokens' levels pairwise
+            # (set intersections), so no row is ever scored on its own
+            levels = self._levels(q_tokens[0])
+            for q in q_tokens[1:]:
+                combined = {}
+                for score, rows in levels:
+                    for score2, rows2 in self._levels(q):
+                        both = rows & rows2
+                        if both:
+                            combined.setdefault(score + score2, set()).update(both)
+                levels = sorted(combined.items(), key=lambda level: -level[0])
+            if not levels:
+                return []
+
+            out = []
+            single = len(q_tokens) == 1
+            matched = None if single else set().union(*(rows for _, rows in levels))
+            for rid in self._leading(" ".join(q_tokens)):
+                if len(out) == limit:
+                    return out
+                if single or rid in matched:
+                    out.append(rid)
+            leading = set(out)
+            for _, rows in levels:
+                if len(out) == limit:
+                    break
+                rows = rows - leading
+                if limit is None:
+                    out += sorted(rows, key=self._order.__getitem__)
+                else:
+                    out += heapq.nsmallest(limit - len(out), rows, key=self._order.__getitem__)
+            return out
+
+    def find(self, query, limit=None):
+        """search() results as rows of the table (as indexed), best first."""
+        with self._lock:
+            ids = self.search(query, limit)
+            return self._frame.loc[ids].copy()
@@ -0,0 +1,14 @@
+# backend/tests/conftest.py
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# the backend modules import each other by name (python app.py from backend/)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# utils/app read these at import: keep the tests off uploads/ and off real SMTP
+# (load_dotenv() doesn't override variables that are already set)
+os.environ["LIFETAG_DATA_DIR"] = tempfile.mkdtemp(prefix="lifetag-tests-")
+os.environ["LIFETAG_STORAGE"] = "csv"
+os.environ["SMTP_HOST"] = ""
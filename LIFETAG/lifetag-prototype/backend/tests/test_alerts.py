@@ -0,0 +1,29 @@
+# backend/tests/test_alerts.py
+import pytest
+
+
+@pytest.fixture(scope="module")
+def app_module():
+    import app
+    return app
+
+
+def test_resolve_alerts_after_an_alert_run(app_module):
+    import utils
+    utils.bulk_add_or_update_stock([
+        {"product_name": "Para", "batch": "T9-B1", "exp": "2020-01-01", "qty": 50, "mrp": "5"},
+        {"product_name": "Dolo", "batch": "T9-B2", "exp": "2020-01-01", "qty": 50, "mrp": "5"},
+    ])
+    keys = utils._active_alert_keys()
+    created = [a for a in app_module.run_alerts_and_send() if a["batch"].startswith("T9-")]
+    assert len(created) == 2
+    # the run's own inserts and last_sent_at stamps keep the active keys current,
+    # they don't force a recount of the alerts table
+    assert utils._active_alert_keys() is keys
+
+    client = app_module.app.test_client()
+    for a in created:
+        r = client.get("/api/resolve_alert", query_string={"alert_id": a["alert_id"], "user": "chemist"})
+        assert r.status_code == 200
+    assert not utils._alert_exists("Para", "T9-B1", "expired")
+    assert not utils._alert_exists("Dolo", "T9-B2", "expired")
@@ -0,0 +1,175 @@
+# backend/tests/test_mailer.py
+"""Outbox delivery against a stand-in SMTP server on localhost."""
+import socketserver
+import threading
+import time
+
+import pytest
+
+from datastore import SqliteTable, Table
+from mailer import OUTBOX_COLUMNS, Outbox, SmtpTransport
+
+INDEXES = {"message_id": ("message_id",), "status": ("status",)}
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply("220 stand-in ESMTP")
+        data, lines = False, []
+        for raw in self.rfile:
+            if data:
+                if raw.rstrip(b"\r\n") == b".":
+                    data = False
+                    server.messages.append(b"".join(lines).decode())
+                    self.reply("250 queued")
+                else:
+                    lines.append(raw[1:] if raw.startswith(b"..") else raw)
+                continue
+            cmd = raw[:4].upper()
+            if cmd in (b"EHLO", b"HELO"):
+                self.reply("250 stand-in")
+            elif cmd == b"MAIL":
+                with server.lock:
+                    server.attempts.append(time.monotonic())
+                    refuse = server.refuse > 0
+                    server.refuse -= refuse
+                self.reply("451 try again later" if refuse else "250 ok")
+            elif cmd == b"RCPT" or cmd in (b"RSET", b"NOOP"):
+                self.reply("250 ok")
+            elif cmd == b"DATA":
+                data, lines = True, []
+                self.reply("354 go ahead")
+            elif cmd == b"QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+
+class _SmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SmtpHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.attempts = []  # monotonic time of every MAIL FROM
+        self.refuse = 0     # refuse this many MAIL FROMs with a 451
+
+
+@pytest.fixture
+def smtp():
+    server = _SmtpServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _outbox(table, smtp, **options):
+    options = {"workers": 1, "poll_interval": 0.02, "max_attempts": 3, "backoff": 0.2, **options}
+    outbox = Outbox(table, **options)
+    outbox.add_transport("default", SmtpTransport("127.0.0.1", smtp.server_address[1],
+                                                  from_email="lifetag@example.com", starttls=False))
+    return outbox
+
+
+def _wait(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def table(tmp_path):
+    return Table("email_outbox", tmp_path / "email_outbox.csv", OUTBOX_COLUMNS, indexes=INDEXES)
+
+
+def test_enqueue_delivers_and_removes_message(table, smtp):
+    outbox = _outbox(table, smtp)
+    try:
+        outbox.enqueue("patient@example.com", "Expiry alert", "Your medicine expires soon")
+        _wait(lambda: smtp.messages and len(table) == 0)
+    finally:
+        outbox.stop()
+    assert len(smtp.messages) == 1
+    assert "To: patient@example.com" in smtp.messages[0]
+    assert "Subject: Expiry alert" in smtp.messages[0]
+
+
+def test_failed_send_is_retried_with_backoff(table, smtp):
+    smtp.refuse = 2
+    outbox = _outbox(table, smtp)
+    try:
+        outbox.enqueue("patient@example.com", "Expiry alert", "body")
+        _wait(lambda: smtp.messages and len(table) == 0)
+    finally:
+        outbox.stop()
+    first, second, third = smtp.attempts
+    # backoff * 2**(attempt-1): 0.2s after the first failure, 0.4s after the second
+    assert second - first >= 0.2
+    assert third - second >= 0.4
+    assert len(smtp.messages) == 1
+
+
+def test_message_is_marked_failed_after_max_attempts(table, smtp):
+    smtp.refuse = 100
+    outbox = _outbox(table, smtp, backoff=0.05)
+    try:
+        outbox.enqueue("patient@example.com", "Expiry alert", "body")
+        _wait(lambda: table.first("status", "failed") is not None)
+        time.sleep(0.3)  # no further attempts once it has failed
+    finally:
+        outbox.stop()
+    row = table.first("message_id", table.frame().iloc[0]["message_id"])
+    assert row["status"] == "failed"
+    assert row["attempts"] == "3"
+    assert "451" in row["last_error"]
+    assert len(smtp.attempts) == 3
+    assert smtp.messages == []
+
+
+def test_workers_sharing_a_table_send_each_message_once(tmp_path, smtp):
+    # two outboxes (as in two worker processes) draining one sqlite outbox
+    tables = [SqliteTable("email_outbox", tmp_path / "email_outbox.csv", OUTBOX_COLUMNS,
+                          indexes=INDEXES, db_path=tmp_path / "lifetag.db") for _ in range(2)]
+    for i in range(20):
+        tables[0].insert({
+            "message_id": f"m{i}", "channel": "default", "recipient": f"p{i}@example.com",
+            "subject": "s", "body": "b", "html": "", "status": "pending", "attempts": 0,
+            "next_attempt_at": "2000-01-01T00:00:00", "last_error": "", "created_at": "",
+        })
+    outboxes = [_outbox(t, smtp, workers=3) for t in tables]
+    try:
+        for outbox in outboxes:
+            outbox.start()
+        _wait(lambda: len(tables[0]) == 0)
+    finally:
+        for outbox in outboxes:
+            outbox.stop()
+    recipients = sorted(line for m in smtp.messages for line in m.splitlines() if line.startswith("To:"))
+    assert recipients == sorted(f"To: p{i}@example.com" for i in range(20))
+
+
+def test_claim_left_by_a_dead_worker_is_released(table, smtp):
+    table.insert({
+        "message_id": "m1", "channel": "default", "recipient": "p@example.com",
+        "subject": "s", "body": "b", "html": "", "status": "sending", "attempts": 0,
+        "next_attempt_at": "2000-01-01T00:00:00", "last_error": "", "created_at": "",
+    })
+    outbox = _outbox(table, smtp)
+    try:
+        outbox.start()
+        _wait(lambda: len(table) == 0)
+    finally:
+        outbox.stop()
+    assert len(smtp.messages) == 1
@@ -0,0 +1,71 @@
+# backend/tests/test_prescriptions.py
+import pytest
+
+
+@pytest.fixture(scope="module")
+def client():
+    from app import app
+    return app.test_client()
+
+
+def test_flutter_shaped_medications_round_trip(client):
+    # what the Flutter doctor screen posts for each medicine
+    meds = [
+        {"name": "Paracetamol 500mg", "dosage": "1 tab", "quantity": 10, "times": ["08:00", "20:00"]},
+        {"name": "Cetirizine", "dosage": "", "quantity": 5, "times": [], "frequency": "daily"},
+    ]
+    r = client.post("/api/create_prescription",
+                    json={"patient_id": "P-flutter", "doctor_name": "Dr. App", "medications": meds})
+    assert r.status_code == 200
+    pid = r.get_json()["prescription_id"]
+
+    got = client.get(f"/api/prescription/{pid}").get_json()["medications"]
+    for sent, back in zip(meds, got):
+        # every key the client sent comes back unchanged ...
+        assert {k: back[k] for k in sent} == sent
+    # ... and the aliases fill the item fields the backend works with
+    assert [(m["product_name"], m["qty"]) for m in got] == [("Paracetamol 500mg", 10), ("Cetirizine", 5)]
+
+    listed = client.get("/api/prescriptions", query_string={"patient_id": "P-flutter"}).get_json()
+    assert [m["times"] for m in listed[0]["medications"]] == [["08:00", "20:00"], []]
+
+
+def test_item_fields_round_trip_unchanged(client):
+    meds = [{"product_name": "Dolo 650", "batch": "B12", "qty": 2, "dosage": "1-0-1"}]
+    r = client.post("/api/create_prescription",
+                    json={"patient_id": "P-web", "doctor_name": "Dr. Web", "medications": meds})
+    pid = r.get_json()["prescription_id"]
+    assert client.get(f"/api/prescription/{pid}").get_json()["medications"] == meds
+
+
+def test_write_for_one_patient_keeps_the_others_etag(client):
+    for patient_id in ("P-etag-a", "P-etag-b"):
+        client.post("/api/create_prescription", json={
+            "patient_id": patient_id, "doctor_name": "Dr. Tag",
+            "medications": [{"product_name": "Dolo 650", "batch": "ETAG-1", "qty": 1}]})
+    urls = {p: f"/api/patient/{p}/prescriptions" for p in ("P-etag-a", "P-etag-b")}
+    tags = {p: client.get(url).headers["ETag"] for p, url in urls.items()}
+
+    client.post("/api/create_prescription", json={
+        "patient_id": "P-etag-a", "doctor_name": "Dr. Tag",
+        "medications": [{"product_name": "Cetirizine", "batch": "ETAG-2", "qty": 1}]})
+
+    r = client.get(urls["P-etag-b"], headers={"If-None-Match": tags["P-etag-b"]})
+    assert r.status_code == 304
+    r = client.get(urls["P-etag-a"], headers={"If-None-Match": tags["P-etag-a"]})
+    assert r.status_code == 200
+    assert len(r.get_json()) == 2
+
+
+def test_bulk_rejects_malformed_medications_by_position(client):
+    good = {"patient_id": "P-bulk", "doctor_name": "Dr. Bulk", "medications": [{"product_name": "Dolo 650"}]}
+    r = client.post("/api/create_prescriptions", json={"prescriptions": [
+        good,
+        {**good, "medications": "Dolo 650"},
+        {**good, "medications": [{"product_name": "Dolo 650"}, "Cetirizine"]},
+        {**good, "prescription_id": ["RX1"]},
+    ]})
+    assert r.status_code == 400
+    assert [e["index"] for e in r.get_json()["errors"]] == [1, 2, 3]
+    # all-or-nothing: the valid entry wasn't written either
+    assert client.get("/api/prescriptions", query_string={"patient_id": "P-bulk"}).get_json() == []
@@ -0,0 +1,56 @@
+# backend/tests/test_rollups.py
+"""Sales rollup totals: two writers adding to the same sqlite rows lose nothing."""
+import multiprocessing
+
+from datastore import SqliteTable, Table
+
+COLUMNS = ["grain", "bucket", "product_name", "pharmacy_id", "count", "qty", "revenue"]
+INDEXES = {"bucket": ("grain", "bucket"), "key": ("grain", "bucket", "product_name", "pharmacy_id")}
+SUMS = {"count": 0, "qty": 0, "revenue": 2}
+
+
+def _sale(product, qty, revenue):
+    return {"grain": "day", "bucket": "2026-10-01", "product_name": product, "pharmacy_id": "PH1",
+            "count": 1, "qty": qty, "revenue": revenue}
+
+
+def _sqlite(tmp):
+    return SqliteTable("sales_rollups", f"{tmp}/sales_rollups.csv", COLUMNS, indexes=INDEXES,
+                       db_path=f"{tmp}/lifetag.db")
+
+
+def _record_sales(tmp, start, n):
+    # one worker process: its own connection to the shared database
+    table = _sqlite(tmp)
+    start.wait()
+    for _ in range(n):
+        table.accumulate("key", [_sale("Dolo 650", 2, 30.1), _sale("Cetirizine", 1, 12.5)], SUMS)
+
+
+def test_two_writers_keep_every_increment(tmp_path):
+    _sqlite(tmp_path)  # create the schema before the writers race
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Event()
+    writers = [ctx.Process(target=_record_sales, args=(str(tmp_path), start, 100)) for _ in range(2)]
+    for w in writers:
+        w.start()
+    start.set()
+    for w in writers:
+        w.join(60)
+        assert w.exitcode == 0
+
+    totals = _sqlite(tmp_path).frame().set_index("product_name")
+    assert len(totals) == 2
+    assert totals.loc["Dolo 650", ["count", "qty", "revenue"]].tolist() == ["200", "400", "6020.0"]
+    assert totals.loc["Cetirizine", ["count", "qty", "revenue"]].tolist() == ["200", "200", "2500.0"]
+
+
+def test_csv_and_sqlite_store_the_same_totals(tmp_path):
+    tables = [Table("sales_rollups", tmp_path / "sales_rollups.csv", COLUMNS, indexes=INDEXES),
+              _sqlite(tmp_path)]
+    for table in tables:
+        table.accumulate("key", [_sale("Dolo 650", 2, 30.1)], SUMS)
+        table.accumulate("key", [_sale(" Dolo 650 ", 3, 45.15), _sale("Cetirizine", 1, 12.5)], SUMS)
+    csv, sqlite = (t.frame().reset_index(drop=True) for t in tables)
+    assert csv.to_dict(orient="records") == sqlite.to_dict(orient="records")
+    assert csv.loc[0, ["count", "qty", "revenue"]].tolist() == ["2", "5", "75.25"]
@@ -0,0 +1,20 @@
+# backend/tests/test_stock.py
+import csv
+from datetime import date, timedelta
+
+import utils
+
+
+def test_stock_added_behind_our_back_is_in_expiry_ranges():
+    soon = (date.today() + timedelta(days=5)).strftime("%d-%m-%Y")
+    past = (date.today() - timedelta(days=5)).strftime("%d-%m-%Y")
+    # rows appended by something other than this process: no exp_date
+    with open(utils.MED_STOCK, newline="", encoding="utf-8") as f:
+        header = next(csv.reader(f))
+    with open(utils.MED_STOCK, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=header)
+        writer.writerow({"product_name": "Outside Soon", "batch": "OUT-1", "exp": soon, "qty": "3"})
+        writer.writerow({"product_name": "Outside Past", "batch": "OUT-2", "exp": past, "qty": "3"})
+
+    assert "OUT-1" in set(utils.expiring_stock(15, include_expired=False)["batch"])
+    assert "OUT-2" in set(utils.expired_stock()["batch"])
@@ -2,14 +2,22 @@
 import os
 import csv
 import json
+import hashlib
 import uuid
+import heapq
+import threading
+from collections import Counter
 from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-UPLOAD_DIR = Path(__file__).parent / "uploads"
+from datastore import open_table, register, table_for
+from dotenv import load_dotenv
+from mailer import OUTBOX_COLUMNS, Outbox, transport_from_env
+from search import SearchIndex
+load_dotenv()  # SMTP_* for the mail transport below
+# LIFETAG_DATA_DIR points the app at another data directory (e.g. in tests)
+UPLOAD_DIR = Path(os.getenv("LIFETAG_DATA_DIR") or Path(__file__).parent / "uploads")
 STATIC_QR_DIR = Path(__file__).parent / "static" / "qr"
 
 # ensure directories exist
@@ -22,6 +30,9 @@ PRESCRIPTIONS = UPLOAD_DIR / "prescriptions.csv"
 SALES = UPLOAD_DIR / "sales.csv"
 PATIENTS = UPLOAD_DIR / "patients.csv"
 ALERTS = UPLOAD_DIR / "alerts.csv"
+PRESCRIPTION_ITEMS = UPLOAD_DIR / "prescription_items.csv"
+EMAIL_OUTBOX = UPLOAD_DIR / "email_outbox.csv"
+SALES_ROLLUPS = UPLOAD_DIR / "sales_rollups.csv"
 
 def ensure_csv(path, headers):
     if not path.exists() or path.stat().st_size == 0:
@@ -30,14 +41,77 @@ def ensure_csv(path, headers):
             writer.writerow(headers)
 
 # ensure CSV headers (patients includes email; alerts extended)
-ensure_csv(MED_STOCK, ["product_name","hsn","mrp","batch","exp","qty","manufacturer","rate","gtin","last_update"])
+ensure_csv(MED_STOCK, ["product_name","hsn","mrp","batch","exp","qty","manufacturer","rate","gtin","last_update","exp_date"])
 ensure_csv(PRESCRIPTIONS, ["prescription_id","patient_id","doctor_name","pharmacy_id","medications_json","created_at","qr_path","status"])
 ensure_csv(SALES, ["sale_id","prescription_id","product_name","batch","qty","sold_at","pharmacy_id"])
 ensure_csv(PATIENTS, ["patient_id","name","age","gender","contact","email","notes","registered_at"])
 ensure_csv(ALERTS, ["alert_id","product_name","batch","exp","days_to_expiry","alert_type","created_at","last_sent_at","resolved","resolved_by","resolved_at"])
+ensure_csv(PRESCRIPTION_ITEMS, ["prescription_id","line_no","product_name","batch","qty","dosage","extra_json"])
+ensure_csv(EMAIL_OUTBOX, OUTBOX_COLUMNS)
+ensure_csv(SALES_ROLLUPS, ["grain","bucket","product_name","pharmacy_id","count","qty","revenue"])
+
+# storage backend: "csv" (in-memory tables written through to the CSVs above)
+# or "sqlite" (uploads/lifetag.db in WAL mode, migrated once from the CSVs)
+STORAGE_BACKEND = os.getenv("LIFETAG_STORAGE", "csv").strip().lower()
+SQLITE_DB = Path(os.getenv("LIFETAG_DB") or UPLOAD_DIR / "lifetag.db")
+
+def _open_table(name, path, columns, **kwargs):
+    if STORAGE_BACKEND == "sqlite":
+        kwargs["db_path"] = SQLITE_DB
+    return register(open_table(STORAGE_BACKEND, name, path, columns, **kwargs))
+
+STOCK_TABLE = _open_table(
+    "medicine_stock", MED_STOCK,
+    ["product_name","hsn","mrp","batch","exp","qty","manufacturer","rate","gtin","last_update","exp_date"],
+    indexes={"product_batch": ("product_name", "batch"), "batch": ("batch",)},
+    casefold=("product_batch", "batch"),
+    # exp_date is the canonical ISO expiry (parsed from exp at ingest)
+    sorted_on=("exp_date",),
+)
+PRESCRIPTIONS_TABLE = _open_table(
+    "prescriptions", PRESCRIPTIONS,
+    ["prescription_id","patient_id","doctor_name","pharmacy_id","medications_json","created_at","qr_path","status"],
+    indexes={"prescription_id": ("prescription_id",), "patient_id": ("patient_id",)},
+)
+SALES_TABLE = _open_table(
+    "sales", SALES,
+    ["sale_id","prescription_id","product_name","batch","qty","sold_at","pharmacy_id"],
+    indexes={"prescription_id": ("prescription_id",)},
+)
+PATIENTS_TABLE = _open_table(
+    "patients", PATIENTS,
+    ["patient_id","name","age","gender","contact","email","notes","registered_at"],
+    indexes={"patient_id": ("patient_id",)},
+)
+# one row per medicine line of a prescription (medications_json is kept for
+# older readers, but the backend reads medicines from here); extra_json holds
+# any other keys the client sent for the line (e.g. the Flutter app's "times")
+PRESCRIPTION_ITEMS_TABLE = _open_table(
+    "prescription_items", PRESCRIPTION_ITEMS,
+    ["prescription_id","line_no","product_name","batch","qty","dosage","extra_json"],
+    indexes={"prescription_id": ("prescription_id",), "product_batch": ("product_name", "batch"), "batch": ("batch",)},
+    casefold=("product_batch", "batch"),
+)
+ALERTS_TABLE = _open_table(
+    "alerts", ALERTS,
+    ["alert_id","product_name","batch","exp","days_to_expiry","alert_type","created_at","last_sent_at","resolved","resolved_by","resolved_at"],
+    indexes={"alert_id": ("alert_id",), "product_batch": ("product_name", "batch"), "batch": ("batch",)},
+    casefold=("product_batch", "batch"),
+)
+
+# sales totals per day / ISO week (bucket = its Monday) / month, product and
+# pharmacy; kept in step with sales by insert_sales()
+SALES_ROLLUPS_TABLE = _open_table(
+    "sales_rollups", SALES_ROLLUPS,
+    ["grain","bucket","product_name","pharmacy_id","count","qty","revenue"],
+    indexes={"bucket": ("grain", "bucket"), "key": ("grain", "bucket", "product_name", "pharmacy_id")},
+)
 
 def read_csv_to_df(path):
-    """Read CSV to DataFrame safely (strings)."""
+    """Read CSV to DataFrame safely (strings). Registered tables are served from memory."""
+    table = table_for(path)
+    if table is not None:
+        return table.frame()
     if path.exists() and path.stat().st_size > 0:
         try:
             return pd.read_csv(path, dtype=str).fillna("")
@@ -46,6 +120,10 @@ def read_csv_to_df(path):
     return pd.DataFrame()
 
 def write_df_to_csv(df, path):
+    table = table_for(path)
+    if table is not None:
+        table.replace(df)
+        return
     Path(path).parent.mkdir(parents=True, exist_ok=True)
     df = df.where(pd.notnull(df), "")
     df.to_csv(path, index=False)
@@ -78,6 +156,111 @@ def _try_parse_date(s):
         pass
     raise ValueError("unrecognized date format: "+s)
 
+@lru_cache(maxsize=65536)
+def _parse_expiry(s):
+    """Memoized _try_parse_date: date for a known format, None otherwise."""
+    try:
+        return _try_parse_date(s)
+    except Exception:
+        return None
+
+def parse_expiry_series(exp):
+    """
+    Parse a whole `exp` column to datetime64 in one pass (NaT where unparseable).
+    Each distinct string is parsed once; stock columns repeat the same few
+    expiry strings, so this is far cheaper than parsing row by row.
+    """
+    exp = pd.Series(exp, dtype=object).fillna("").astype(str).str.strip()
+    uniq = exp.unique()
+    parsed = {u: _parse_expiry(u) for u in uniq}
+    return pd.to_datetime(exp.map(parsed), errors="coerce")
+
+def expiry_days(exp, today=None):
+    """Days until expiry for a whole `exp` column (float, NaN where unparseable)."""
+    today = pd.Timestamp(today or datetime.utcnow().date())
+    return (parse_expiry_series(exp) - today).dt.days
+
+def canonical_expiry(exp):
+    """ISO date string stored in stock.exp_date for a raw `exp` value ("" if unparseable)."""
+    d = _parse_expiry(str(exp or "").strip())
+    return d.isoformat() if d else ""
+
+def _stock_expiry_dates(df):
+    """datetime64 expiry per stock row: exp_date where set, else parsed from exp."""
+    exp = df["exp"] if "exp" in df.columns else pd.Series("", index=df.index)
+    if "exp_date" not in df.columns:
+        return parse_expiry_series(exp)
+    dates = pd.to_datetime(df["exp_date"].where(df["exp_date"] != ""), format="%Y-%m-%d", errors="coerce")
+    missing = dates.isna()
+    if missing.any():
+        dates[missing] = parse_expiry_series(exp[missing])
+    return dates
+
+def with_expiry(df, today=None):
+    """Copy of a stock frame with `days_to_expiry` (int or None) and `expired` columns."""
+    df = df.copy()
+    days = (_stock_expiry_dates(df) - pd.Timestamp(today or datetime.utcnow().date())).dt.days
+    df["expired"] = (days < 0).to_numpy()
+    df["days_to_expiry"] = pd.Series([None if pd.isna(d) else int(d) for d in days], index=df.index, dtype=object)
+    return df
+
+def _backfill_exp_dates():
+    """Set exp_date on stock rows that predate it (one write, only if anything changed)."""
+    df = STOCK_TABLE.frame()
+    if df.empty or "exp" not in df.columns:
+        return 0
+    current = df["exp_date"] if "exp_date" in df.columns else pd.Series("", index=df.index)
+    todo = df[(current == "") & (df["exp"].astype(str).str.strip() != "")]
+    if todo.empty:
+        return 0
+    dates = parse_expiry_series(todo["exp"])
+    updates = [(rid, {"exp_date": d.date().isoformat()}) for rid, d in dates.dropna().items()]
+    if updates:
+        STOCK_TABLE.apply(updates=updates)
+    return len(updates)
+
+# our own stock writes set exp_date; rows that arrive behind our back (an
+# edited or replaced CSV, another worker) may not, so backfill again whenever
+# the table changes that way, before the exp_date range reads below
+_exp_dates_version = None    # STOCK_TABLE.foreign_version the last backfill saw
+_exp_dates_lock = threading.Lock()
+
+def _ensure_exp_dates():
+    global _exp_dates_version
+    with _exp_dates_lock:
+        version = STOCK_TABLE.foreign_version
+        if version != _exp_dates_version:
+            _backfill_exp_dates()
+            _exp_dates_version = version
+
+_ensure_exp_dates()
+
+def expiring_stock(within_days=None, include_expired=True, limit=None, today=None):
+    """
+    Stock rows ordered by expiry, read from the sorted exp_date index:
+    - within_days=N -> everything expiring on or before today+N
+    - include_expired=False -> only rows expiring today or later
+    - limit=K with within_days=None -> the next K to expire
+    """
+    _ensure_exp_dates()
+    today = today or datetime.utcnow().date()
+    lo = None if include_expired else today.isoformat()
+    hi = None if within_days is None else (today + timedelta(days=int(within_days))).isoformat()
+    return STOCK_TABLE.range("exp_date", lo=lo, hi=hi, limit=limit)
+
+def expired_stock(today=None):
+    """Stock rows whose expiry date has passed."""
+    _ensure_exp_dates()
+    today = today or datetime.utcnow().date()
+    return STOCK_TABLE.range("exp_date", hi=(today - timedelta(days=1)).isoformat())
+
+# medicine search: names, manufacturer, HSN and GTIN; follows stock changes
+MEDICINE_INDEX = SearchIndex(STOCK_TABLE, ("product_name", "manufacturer", "hsn", "gtin"))
+
+def search_stock(query, limit=None):
+    """Stock rows matching `query`, best match first (at most `limit`)."""
+    return MEDICINE_INDEX.find(query, limit)
+
 # ---------------- existing helpers ----------------
 
 def add_or_update_stock(row_dict):
@@ -91,16 +274,6 @@ def add_or_update_stock(row_dict):
 
     expected_cols = ["product_name", "hsn", "mrp", "batch", "exp", "qty", 
                      "manufacturer", "rate", "gtin", "last_update"]
-    df = read_csv_to_df(MED_STOCK)
-    if df.empty:
-        df = pd.DataFrame(columns=expected_cols)
-
-    # Ensure all required columns exist
-    for c in expected_cols:
-        if c not in df.columns:
-            df[c] = ""
-
-    df = df.fillna("")
 
     # Normalize incoming record
     incoming = {k: str(row_dict.get(k, "")).strip() for k in expected_cols}
@@ -118,7 +291,8 @@ def add_or_update_stock(row_dict):
 
     # Reuse product name if missing and same batch found
     if not incoming["product_name"] and incoming["batch"]:
-        same_batch = df[df["batch"] == incoming["batch"]]
+        same_batch = STOCK_TABLE.lookup("batch", incoming["batch"])
+        same_batch = same_batch[same_batch["batch"] == incoming["batch"]]
         if not same_batch.empty:
             incoming["product_name"] = same_batch.iloc[0]["product_name"]
 
@@ -126,32 +300,38 @@ def add_or_update_stock(row_dict):
     key_cols = ["product_name", "hsn", "mrp", "batch", "exp", 
                 "manufacturer", "rate", "gtin"]
 
+    # Only rows with the same product+batch can match; compare the rest on those
+    df = STOCK_TABLE.lookup("product_batch", incoming["product_name"], incoming["batch"])
+    for c in expected_cols:
+        if c not in df.columns:
+            df[c] = ""
+
     # Build match mask
     mask = pd.Series(True, index=df.index)
     for c in key_cols:
         mask &= df[c].astype(str).str.strip().str.lower() == incoming[c].lower()
 
-    if mask.any():
-        # ✅ Exact match found → increment quantity
-        idx = df[mask].index[0]
-        try:
-            prev_qty = int(float(df.at[idx, "qty"] or 0))
-        except Exception:
-            prev_qty = 0
-        df.at[idx, "qty"] = prev_qty + incoming_qty
-        df.at[idx, "last_update"] = datetime.utcnow().isoformat()
-        print(f"🔁 Updated existing stock for {incoming['product_name']} batch {incoming['batch']}")
-    else:
-        # 🆕 New entry → append row
-        new_row = incoming.copy()
-        new_row["qty"] = incoming_qty
-        new_row["last_update"] = datetime.utcnow().isoformat()
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        print(f"➕ Added new stock entry for {incoming['product_name']} batch {incoming['batch']}")
-
-    # Safely write back to CSV
     try:
-        write_df_to_csv(df, MED_STOCK)
+        if mask.any():
+            # ✅ Exact match found → increment quantity
+            idx = df[mask].index[0]
+            try:
+                prev_qty = int(float(df.at[idx, "qty"] or 0))
+            except Exception:
+                prev_qty = 0
+            STOCK_TABLE.update([idx], {"qty": prev_qty + incoming_qty,
+                                       "last_update": datetime.utcnow().isoformat()})
+            mark_stock_dirty(incoming["product_name"], incoming["batch"])
+            print(f"🔁 Updated existing stock for {incoming['product_name']} batch {incoming['batch']}")
+        else:
+            # 🆕 New entry → append row
+            new_row = incoming.copy()
+            new_row["qty"] = incoming_qty
+            new_row["last_update"] = datetime.utcnow().isoformat()
+            new_row["exp_date"] = canonical_expiry(incoming["exp"])
+            STOCK_TABLE.insert(new_row)
+            mark_stock_dirty(incoming["product_name"], incoming["batch"])
+            print(f"➕ Added new stock entry for {incoming['product_name']} batch {incoming['batch']}")
     except Exception as e:
         print(f"❌ CSV write error: {e}")
         return False
@@ -159,45 +339,276 @@ def add_or_update_stock(row_dict):
     return True
 
 
-def create_prescription(patient_id, doctor_name, pharmacy_id, medications):
-    pid = str(uuid.uuid4())
+def bulk_add_or_update_stock(rows):
+    """
+    Add or update many stock rows at once (e.g. a whole distributor bill).
+    Same rules as add_or_update_stock, applied to the whole frame in one pass:
+    - rows with zero/invalid qty are skipped
+    - a blank product name is filled from the first row with the same batch,
+      existing stock first, then earlier rows of this bill
+    - rows whose 8 key fields match existing stock (case-insensitive) increment
+      its qty, everything else becomes a new row (bill rows repeating the same
+      key are summed into one)
+    The merge is a single join against current stock and is persisted with one write.
+    Returns (updated, added) counts.
+    """
+    expected_cols = ["product_name", "hsn", "mrp", "batch", "exp", "qty",
+                     "manufacturer", "rate", "gtin", "last_update"]
+    key_cols = ["product_name", "hsn", "mrp", "batch", "exp",
+                "manufacturer", "rate", "gtin"]
+
+    inc = rows.copy() if isinstance(rows, pd.DataFrame) else pd.DataFrame(list(rows))
+    if inc.empty:
+        return 0, 0
+    inc = inc.reset_index(drop=True)
+    for c in key_cols:
+        inc[c] = inc[c].fillna("").astype(str).str.strip() if c in inc.columns else ""
+    qty = pd.to_numeric(inc["qty"] if "qty" in inc.columns else 0, errors="coerce")
+    qty = qty.replace([float("inf"), float("-inf")], 0).fillna(0)
+    inc["qty"] = qty.astype(int)
+    inc["_pos"] = range(len(inc))
+    inc = inc[inc["qty"] > 0]
+    if inc.empty:
+        print("⚠️ No valid quantities in upload")
+        return 0, 0
+
+    stock = STOCK_TABLE.frame()
+    for c in expected_cols:
+        if c not in stock.columns:
+            stock[c] = ""
+
+    # Reuse product name if missing and same batch found
+    blank = (inc["product_name"] == "") & (inc["batch"] != "")
+    if blank.any():
+        blank_batches = inc.loc[blank, "batch"]
+        filled = blank_batches.map(stock.drop_duplicates("batch").set_index("batch")["product_name"])
+        # otherwise the first earlier bill row with that batch (it was added first)
+        first_seen = inc.drop_duplicates("batch").set_index("batch")
+        earlier = blank_batches.map(first_seen["_pos"]) < inc.loc[blank, "_pos"]
+        from_bill = blank_batches.map(first_seen["product_name"]).where(earlier)
+        inc.loc[blank, "product_name"] = filled.fillna(from_bill).fillna("")
+
+    # Composite key: all 8 key fields, trimmed and lower-cased
+    lk = [f"_k_{c}" for c in key_cols]
+    for c in key_cols:
+        inc[f"_k_{c}"] = inc[c].str.lower()
+        stock[f"_k_{c}"] = stock[c].astype(str).str.strip().str.lower()
+
+    totals = inc.groupby(lk, sort=False)["qty"].sum().rename("_total")
+    incoming = inc.drop_duplicates(lk).join(totals, on=lk)
+    targets = stock.drop_duplicates(lk)[lk + ["qty"]].rename(columns={"qty": "_stock_qty"})
+    targets["_row_id"] = targets.index
+    merged = incoming.merge(targets, on=lk, how="left")
+
+    now = datetime.utcnow().isoformat()
+    matched = merged[merged["_row_id"].notna()]
+    prev = pd.to_numeric(matched["_stock_qty"], errors="coerce").fillna(0).astype(int)
+    updates = [
+        (int(row_id), {"qty": int(p + t), "last_update": now})
+        for row_id, p, t in zip(matched["_row_id"], prev, matched["_total"])
+    ]
+    new_rows = merged[merged["_row_id"].isna()][key_cols + ["_total"]].rename(columns={"_total": "qty"})
+    new_rows["last_update"] = now
+    dates = parse_expiry_series(new_rows["exp"])
+    new_rows["exp_date"] = dates.dt.strftime("%Y-%m-%d").fillna("")
+    inserts = new_rows[expected_cols + ["exp_date"]].to_dict(orient="records")
+
+    STOCK_TABLE.apply(updates=updates, inserts=inserts)
+    for p, b in zip(incoming["product_name"], incoming["batch"]):
+        mark_stock_dirty(p, b)
+    print(f"🔁 Updated {len(updates)} existing stock entries, ➕ added {len(inserts)} new")
+    return len(updates), len(inserts)
+
+
+# ---------------- prescription line items ----------------
+
+ITEM_FIELDS = ("product_name", "batch", "qty", "dosage")
+# other names clients use for the item fields (the Flutter doctor screen
+# sends {name, dosage, quantity, times})
+ITEM_ALIASES = {"product_name": ("name",), "qty": ("quantity",)}
+
+def _item_value(med, field):
+    value = med.get(field)
+    for alias in ITEM_ALIASES.get(field, ()):
+        if value is None or value == "":
+            value = med.get(alias)
+    return "" if value is None else value
+
+def _item_rows(prescription_id, medications):
+    rows = []
+    for n, m in enumerate(medications or []):
+        # keys that have no column are kept verbatim and merged back on read
+        extra = {k: v for k, v in m.items() if k not in ITEM_FIELDS}
+        rows.append({
+            "prescription_id": prescription_id,
+            "line_no": n,
+            "product_name": str(_item_value(m, "product_name")).strip(),
+            "batch": str(_item_value(m, "batch")).strip(),
+            "qty": _item_value(m, "qty"),
+            "dosage": _item_value(m, "dosage"),
+            "extra_json": json.dumps(extra) if extra else "",
+        })
+    return rows
+
+def _medication(item):
+    """prescription_items row -> the medication dict as the client sent it, plus the item fields."""
+    qty = item.get("qty", "")
+    try:
+        qty = int(qty) if float(qty) == int(float(qty)) else float(qty)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    med = {}
+    if item.get("extra_json"):
+        try:
+            med = json.loads(item["extra_json"])
+        except ValueError:
+            pass
+        med = med if isinstance(med, dict) else {}
+    med.update(product_name=item.get("product_name", ""), batch=item.get("batch", ""),
+               qty=qty, dosage=item.get("dosage", ""))
+    return med
+
+def _decode_medications(medications_json):
+    try:
+        meds = json.loads(medications_json or "[]")
+    except Exception:
+        return []
+    return [m for m in meds if isinstance(m, dict)] if isinstance(meds, list) else []
+
+def _group_items(items):
+    """prescription_id -> [medication, ...] in line order."""
+    if items.empty:
+        return {}
+    items = items.assign(_line=pd.to_numeric(items["line_no"], errors="coerce")).sort_values("_line", kind="stable")
+    return {pid: [_medication(r) for r in g.to_dict(orient="records")]
+            for pid, g in items.groupby("prescription_id", sort=False)}
+
+def prescription_records(pres_df):
+    """
+    Prescription rows as dicts with a `medications` list built from
+    prescription_items. Rows without items (written by something other than
+    the backend) fall back to decoding medications_json (into the same shape).
+    """
+    if pres_df.empty:
+        return []
+    pids = list(pres_df["prescription_id"])
+    if len(pids) <= 32:
+        frames = [PRESCRIPTION_ITEMS_TABLE.lookup("prescription_id", pid) for pid in pids]
+        frames = [f for f in frames if not f.empty]
+        items = pd.concat(frames) if frames else pd.DataFrame()
+    else:
+        items = PRESCRIPTION_ITEMS_TABLE.frame()
+        if not items.empty:
+            items = items[items["prescription_id"].isin(set(pids))]
+    grouped = _group_items(items)
+    out = []
+    for rec in pres_df.to_dict(orient="records"):
+        meds = grouped.get(rec["prescription_id"])
+        if meds is None:
+            meds = [_medication(r) for r in _item_rows(rec["prescription_id"],
+                                                          _decode_medications(rec.get("medications_json")))]
+        rec["medications"] = meds
+        out.append(rec)
+    return out
+
+def prescription_medications(pres):
+    """Medication list for one prescription row (dict)."""
+    return prescription_records(pd.DataFrame([pres]))[0]["medications"]
+
+def _backfill_prescription_items():
+    """Write prescription_items for prescriptions that predate it (one write)."""
+    pres_df = PRESCRIPTIONS_TABLE.frame()
+    if pres_df.empty:
+        return 0
+    items = PRESCRIPTION_ITEMS_TABLE.frame()
+    done = set(items["prescription_id"]) if not items.empty else set()
+    rows = []
+    for pid, meds_json in zip(pres_df["prescription_id"], pres_df.get("medications_json", [""] * len(pres_df))):
+        if pid and pid not in done:
+            rows.extend(_item_rows(pid, _decode_medications(meds_json)))
+            done.add(pid)
+    if rows:
+        PRESCRIPTION_ITEMS_TABLE.insert(rows)
+    return len(rows)
+
+def _backfill_item_extras():
+    """
+    Item rows written before extra_json existed dropped every key but the
+    item fields; restore them (and the aliased fields) from medications_json,
+    in one write. Runs once: afterwards the column exists.
+    """
+    items = PRESCRIPTION_ITEMS_TABLE.frame()
+    if "extra_json" in items.columns or len(items.columns) == 0:
+        return 0
+    pres_df = PRESCRIPTIONS_TABLE.frame().reindex(columns=["prescription_id", "medications_json"], fill_value="")
+    meds_of = dict(zip(pres_df["prescription_id"], pres_df["medications_json"]))
+    rebuilt = {}
+    for pid in set(items["prescription_id"]):
+        for row in _item_rows(pid, _decode_medications(meds_of.get(pid))):
+            rebuilt[(pid, str(row["line_no"]))] = row
+    items["extra_json"] = ""
+    restored = 0
+    for label, pid, line_no in zip(items.index, items["prescription_id"], items["line_no"]):
+        row = rebuilt.get((pid, str(line_no)))
+        if row is None:
+            continue
+        for col in ("product_name", "qty", "extra_json"):
+            if items.at[label, col] == "" and row[col] != "":
+                items.at[label, col] = str(row[col])
+        restored += items.at[label, "extra_json"] != ""
+    PRESCRIPTION_ITEMS_TABLE.replace(items)
+    return restored
+
+_backfill_item_extras()
+_backfill_prescription_items()
+
+def create_prescription(patient_id, doctor_name, pharmacy_id, medications, prescription_id=None):
+    return create_prescriptions([{
+        "patient_id": patient_id, "doctor_name": doctor_name, "pharmacy_id": pharmacy_id,
+        "medications": medications, "prescription_id": prescription_id,
+    }])[0]
+
+def create_prescriptions(entries):
+    """
+    Insert several prescriptions (dicts with patient_id, doctor_name,
+    pharmacy_id, medications and optionally prescription_id) with one write
+    per table. Returns their prescription ids, in order.
+    """
     created_at = datetime.utcnow().isoformat()
-    row = {
-        "prescription_id": pid,
-        "patient_id": patient_id,
-        "doctor_name": doctor_name,
-        "pharmacy_id": pharmacy_id,
-        "medications_json": json.dumps(medications),
-        "created_at": created_at,
-        "qr_path": "",
-        "status": "created"
-    }
-    df = read_csv_to_df(PRESCRIPTIONS)
-    if df.empty:
-        df = pd.DataFrame(columns=list(row.keys()))
-    df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-    write_df_to_csv(df, PRESCRIPTIONS)
-    return pid
+    rows, items, lines = [], [], []
+    for e in entries:
+        pid = e.get("prescription_id") or str(uuid.uuid4())
+        rows.append({
+            "prescription_id": pid,
+            "patient_id": e["patient_id"],
+            "doctor_name": e["doctor_name"],
+            "pharmacy_id": e["pharmacy_id"],
+            "medications_json": json.dumps(e["medications"]),
+            "created_at": created_at,
+            # served (rendered on demand) at /static/qr/<qr_path>
+            "qr_path": f"{pid}.png",
+            "status": "created"
+        })
+        lines.append(_item_rows(pid, e["medications"]))
+        items += lines[-1]
+    PRESCRIPTIONS_TABLE.insert(rows)
+    PRESCRIPTION_ITEMS_TABLE.insert(items)
+    for e, meds in zip(entries, lines):
+        index_patient_meds(e["patient_id"], meds)
+        invalidate_patient(e["patient_id"])
+    return [r["prescription_id"] for r in rows]
 
 def get_prescription(pid):
-    df = read_csv_to_df(PRESCRIPTIONS)
-    if df.empty:
-        return None
-    rec = df[df['prescription_id'] == pid]
-    if rec.empty:
-        return None
-    row = rec.iloc[0].to_dict()
-    row['medications'] = json.loads(row.get('medications_json') or "[]")
-    return row
+    rows = prescription_records(PRESCRIPTIONS_TABLE.lookup("prescription_id", pid))
+    return rows[0] if rows else None
 
 def mark_prescription_qr(pid, qr_path):
-    df = read_csv_to_df(PRESCRIPTIONS)
-    mask = df['prescription_id'] == pid if not df.empty else pd.Series(dtype=bool)
-    if mask.any():
-        df.loc[mask, 'qr_path'] = qr_path
-        write_df_to_csv(df, PRESCRIPTIONS)
-        return True
-    return False
+    rows = PRESCRIPTIONS_TABLE.lookup("prescription_id", pid)
+    if rows.empty:
+        return False
+    PRESCRIPTIONS_TABLE.update(rows.index, {"qr_path": qr_path})
+    invalidate_patient(rows.iloc[0]["patient_id"])
+    return True
 
 def register_patient(patient_info):
     pid = str(uuid.uuid4())
@@ -205,13 +616,147 @@ def register_patient(patient_info):
     patient_info.setdefault("email", "")
     patient_info['patient_id'] = pid
     patient_info['registered_at'] = datetime.utcnow().isoformat()
-    df = read_csv_to_df(PATIENTS)
-    if df.empty:
-        df = pd.DataFrame(columns=["patient_id","name","age","gender","contact","email","notes","registered_at"])
-    df = pd.concat([df, pd.DataFrame([patient_info])], ignore_index=True)
-    write_df_to_csv(df, PATIENTS)
+    PATIENTS_TABLE.insert(patient_info)
+    invalidate_patient(pid)
     return pid
 
+# ---------------- sales rollups ----------------
+
+def _number(value):
+    try:
+        return float(str(value).strip() or 0)
+    except ValueError:
+        return 0.0
+
+def _sale_buckets(day):
+    """(grain, bucket) keys a sale made on `day` (a date) counts towards."""
+    monday = day - timedelta(days=day.weekday())
+    return [("day", day.isoformat()), ("week", monday.isoformat()), ("month", day.strftime("%Y-%m"))]
+
+def _sale_day(sold_at):
+    try:
+        return datetime.fromisoformat(str(sold_at).strip()[:10]).date()
+    except ValueError:
+        return None
+
+def _sale_price(product_name, batch):
+    """MRP of the stock row for (product, batch), 0 if unknown."""
+    stock = STOCK_TABLE.lookup("product_batch", product_name, batch)
+    return _number(stock.iloc[0]["mrp"]) if not stock.empty else 0.0
+
+def _add_to_rollups(totals):
+    """
+    Add {(grain, bucket, product, pharmacy): [count, qty, revenue]} to the table
+    in one write; the sqlite backend does the adding inside the transaction, so
+    workers recording sales at the same time don't lose each other's totals.
+    """
+    rows = [{"grain": grain, "bucket": bucket, "product_name": product_name, "pharmacy_id": pharmacy_id,
+             "count": count, "qty": int(qty), "revenue": revenue}
+            for (grain, bucket, product_name, pharmacy_id), (count, qty, revenue) in totals.items()]
+    SALES_ROLLUPS_TABLE.accumulate("key", rows, {"count": 0, "qty": 0, "revenue": 2})
+
+def insert_sales(rows):
+    """
+    Insert sale rows and add them to the rollups. Revenue is qty x the MRP
+    of the stock row for the sale's (product, batch) at the time of sale.
+    """
+    SALES_TABLE.insert(rows)
+    totals = {}
+    for r in rows:
+        day = _sale_day(r.get("sold_at"))
+        if day is None:
+            continue
+        qty = int(_number(r.get("qty")))
+        revenue = qty * _sale_price(r.get("product_name", ""), r.get("batch", ""))
+        for grain, bucket in _sale_buckets(day):
+            t = totals.setdefault((grain, bucket, str(r.get("product_name", "")).strip(),
+                                   str(r.get("pharmacy_id", "")).strip()), [0, 0, 0.0])
+            t[0] += 1
+            t[1] += qty
+            t[2] += revenue
+    if totals:
+        _add_to_rollups(totals)
+
+def _backfill_sales_rollups():
+    """Build the rollups from sales.csv when the rollup table is new (one write)."""
+    if len(SALES_ROLLUPS_TABLE) or not len(SALES_TABLE):
+        return 0
+    sales = SALES_TABLE.frame()
+    stock = STOCK_TABLE.frame()
+    days = sales["sold_at"].map(_sale_day)
+    sales = pd.DataFrame({
+        "product_name": sales["product_name"].astype(str).str.strip(),
+        "pharmacy_id": sales["pharmacy_id"].astype(str).str.strip(),
+        "key": sales["product_name"].astype(str).str.strip().str.lower(),
+        "batch": sales["batch"].astype(str).str.strip().str.lower(),
+        "qty": sales["qty"].map(_number).astype(int),
+        "day": days,
+    })[days.notna()]
+    if sales.empty:
+        return 0
+    if not stock.empty:
+        prices = pd.DataFrame({
+            "key": stock["product_name"].astype(str).str.strip().str.lower(),
+            "batch": stock["batch"].astype(str).str.strip().str.lower(),
+            "mrp": stock["mrp"].map(_number),
+        }).drop_duplicates(["key", "batch"])
+        sales = sales.merge(prices, on=["key", "batch"], how="left")
+    else:
+        sales["mrp"] = 0.0
+    sales["revenue"] = sales["qty"] * sales["mrp"].fillna(0)
+    rows = []
+    for i, grain in enumerate(("day", "week", "month")):
+        sales["bucket"] = sales["day"].map(lambda d: _sale_buckets(d)[i][1])
+        grouped = sales.groupby(["bucket", "product_name", "pharmacy_id"]).agg(
+            count=("qty", "size"), qty=("qty", "sum"), revenue=("revenue", "sum")).reset_index()
+        for r in grouped.itertuples(index=False):
+            rows.append({"grain": grain, "bucket": r.bucket, "product_name": r.product_name,
+                         "pharmacy_id": r.pharmacy_id, "count": int(r.count), "qty": int(r.qty),
+                         "revenue": round(float(r.revenue), 2)})
+    SALES_ROLLUPS_TABLE.insert(rows)
+    return len(rows)
+
+_backfill_sales_rollups()
+
+def cover_range(start, end):
+    """
+    Rollup buckets that exactly cover the days start..end (dates, inclusive):
+    whole months where they fit, then whole weeks, then single days. A week
+    that would run into a month that fits whole is left as days.
+    """
+    def month_after(day):
+        return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+    buckets = []
+    day = start
+    while day <= end:
+        next_month = month_after(day)
+        week_end = day + timedelta(days=6)
+        if day.day == 1 and next_month - timedelta(days=1) <= end:
+            buckets.append(("month", day.strftime("%Y-%m")))
+            day = next_month
+        elif (day.weekday() == 0 and week_end <= end
+              and (week_end < next_month or month_after(next_month) - timedelta(days=1) > end)):
+            buckets.append(("week", day.isoformat()))
+            day += timedelta(days=7)
+        else:
+            buckets.append(("day", day.isoformat()))
+            day += timedelta(days=1)
+    return buckets
+
+def sales_rollup(buckets, pharmacy_id=None):
+    """Rollup rows for the given (grain, bucket) keys, optionally for one pharmacy."""
+    frames = [SALES_ROLLUPS_TABLE.lookup("bucket", grain, bucket) for grain, bucket in buckets]
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=["grain", "bucket", "product_name", "pharmacy_id", "count", "qty", "revenue"])
+    df = pd.concat(frames)
+    if pharmacy_id:
+        df = df[df["pharmacy_id"].str.lower() == pharmacy_id.strip().lower()]
+    for col in ("count", "qty", "revenue"):
+        df[col] = df[col].map(_number)
+    return df
+
 def record_sale(prescription_id, product_name, batch, qty, pharmacy_id):
     sale_id = str(uuid.uuid4())
     row = {
@@ -223,23 +768,26 @@ def record_sale(prescription_id, product_name, batch, qty, pharmacy_id):
         "sold_at": datetime.utcnow().isoformat(),
         "pharmacy_id": pharmacy_id
     }
-        # --- After writing the sale record ---
-    stock_df = read_csv_to_df(MED_STOCK)
-    stock_row = stock_df[stock_df['batch'] == batch]
+    insert_sales([row])
+    index_dispensed_items(prescription_id, [row])
+
+    # --- After writing the sale record ---
+    stock_row = STOCK_TABLE.lookup("batch", batch)
+    stock_row = stock_row[stock_row['batch'] == batch]
 
     if not stock_row.empty:
         exp_str = stock_row.iloc[0]['exp']
-        exp_date = datetime.strptime(exp_str, "%b-%y")  # e.g. 'Aug-25'
-        days_to_expiry = (exp_date - datetime.now()).days
+        exp_date = _parse_expiry(str(exp_str).strip())  # e.g. 'Aug-25'
+        if exp_date is None:
+            return
+        days_to_expiry = (exp_date - datetime.now().date()).days
 
         # Get prescription info for patient email
-        presc_df = read_csv_to_df(PRESCRIPTIONS)
-        presc_row = presc_df[presc_df['prescription_id'] == prescription_id]
+        presc_row = PRESCRIPTIONS_TABLE.lookup("prescription_id", prescription_id)
 
         if not presc_row.empty:
             patient_id = presc_row.iloc[0]['patient_id']
-            patient_df = read_csv_to_df(PATIENTS)
-            patient_row = patient_df[patient_df['patient_id'] == patient_id]
+            patient_row = PATIENTS_TABLE.lookup("patient_id", patient_id)
 
             if not patient_row.empty:
                 patient_email = patient_row.iloc[0]['email']
@@ -267,14 +815,11 @@ def record_sale(prescription_id, product_name, batch, qty, pharmacy_id):
 
 
 def decrement_stock(product_name, batch, qty):
-    df = read_csv_to_df(MED_STOCK)
-    if df.empty:
+    if len(STOCK_TABLE) == 0:
         return False, "stock empty"
-    df['product_name'] = df['product_name'].astype(str).fillna("")
-    df['batch'] = df['batch'].astype(str).fillna("")
-    df['exp'] = df['exp'].astype(str).fillna("")
-    # Prefer to match product+batch+exp if available; otherwise match product+batch
-    mask = (df['product_name'].str.lower() == str(product_name).strip().lower()) & (df['batch'] == str(batch).strip())
+    df = STOCK_TABLE.lookup("product_batch", product_name, batch)
+    # product name is matched case-insensitively, batch exactly
+    mask = df['batch'] == str(batch).strip() if not df.empty else pd.Series(dtype=bool)
     if not mask.any():
         return False, "batch not found"
     idx = df[mask].index[0]
@@ -284,31 +829,71 @@ def decrement_stock(product_name, batch, qty):
         current = 0
     if current < qty:
         return False, f"not enough stock (have {current})"
-    df.at[idx,'qty'] = current - qty
-    df.at[idx,'last_update'] = datetime.utcnow().isoformat()
-    write_df_to_csv(df, MED_STOCK)
+    STOCK_TABLE.update([idx], {"qty": current - qty, "last_update": datetime.utcnow().isoformat()})
+    mark_stock_dirty(product_name, batch)
     return True, "ok"
 
 # ---------------- ALERTS logic ----------------
-
-def _alert_exists(alerts_df, product_name, batch, alert_type):
-    if alerts_df.empty:
-        return False
-    pn = str(product_name).strip().lower()
-    bt = str(batch).strip()
-    exists = (
-        (alerts_df['product_name'].astype(str).str.lower() == pn) &
-        (alerts_df['batch'].astype(str) == bt) &
-        (alerts_df['alert_type'] == alert_type) &
-        (alerts_df['resolved'] != "yes")
-    )
-    return exists.any()
+# Unresolved alerts are tracked as a count of active rows per (product, batch,
+# alert_type) key so duplicate checks are O(1) instead of masking the whole
+# (ever-growing) alerts table. Built from the table on first use and kept up to
+# date by our own creates/resolves; if the table's version moves by anything
+# other than our own write (another worker, an edited file) it is rebuilt.
+
+_active_alerts = None          # Counter: key -> number of unresolved rows
+_active_version = None         # ALERTS_TABLE.version the counts reflect
+_active_lock = threading.Lock()
+
+def _alert_key(product_name, batch, alert_type):
+    return (str(product_name or "").strip().lower(), str(batch or "").strip().lower(),
+            str(alert_type or "").strip().lower())
+
+def _active_alert_keys():
+    global _active_alerts, _active_version
+    version = ALERTS_TABLE.version
+    if _active_alerts is None or version != _active_version:
+        df = ALERTS_TABLE.frame().reindex(columns=["product_name", "batch", "alert_type", "resolved"], fill_value="")
+        df = df[df["resolved"] != "yes"]
+        _active_alerts = Counter(_alert_key(p, b, t) for p, b, t in zip(df["product_name"], df["batch"], df["alert_type"]))
+        _active_version = version
+    return _active_alerts
+
+def _track_alerts(rows, active=None):
+    """
+    Count (active=True) or uncount the keys of alert rows we just inserted or
+    resolved; called right after the single table write that changed them.
+    active=None is for our writes that leave the active keys alone (last_sent_at
+    stamps): only the tracked version moves on.
+    """
+    global _active_version
+    if not rows:
+        return
+    with _active_lock:
+        if _active_alerts is not None and _active_version is not None:
+            if ALERTS_TABLE.version != _active_version + 1:
+                # someone else wrote too; recount on the next check
+                _active_version = None
+            else:
+                _active_version += 1
+                for r in rows if active is not None else ():
+                    key = _alert_key(r.get("product_name"), r.get("batch"), r.get("alert_type"))
+                    if active:
+                        _active_alerts[key] += 1
+                    elif r.get("resolved") != "yes":
+                        # the key stays active while other unresolved rows share it
+                        n = _active_alerts.get(key, 0)
+                        if n > 1:
+                            _active_alerts[key] = n - 1
+                        else:
+                            _active_alerts.pop(key, None)
+    invalidate_patients_for_batches(r.get("batch") for r in rows)
+
+def _alert_exists(product_name, batch, alert_type):
+    with _active_lock:
+        return _alert_key(product_name, batch, alert_type) in _active_alert_keys()
 
 def create_alert_row(product_name, batch, exp_raw, days_to_expiry, alert_type):
-    alerts_df = read_csv_to_df(ALERTS)
-    if alerts_df.empty:
-        alerts_df = pd.DataFrame(columns=["alert_id","product_name","batch","exp","days_to_expiry","alert_type","created_at","last_sent_at","resolved","resolved_by","resolved_at"])
-    if _alert_exists(alerts_df, product_name, batch, alert_type):
+    if _alert_exists(product_name, batch, alert_type):
         return None
 
     # Safe handling for empty/non-numeric days_to_expiry
@@ -332,21 +917,17 @@ def create_alert_row(product_name, batch, exp_raw, days_to_expiry, alert_type):
         "resolved_by": "",
         "resolved_at": ""
     }
-    alerts_df = pd.concat([alerts_df, pd.DataFrame([row])], ignore_index=True)
-    write_df_to_csv(alerts_df, ALERTS)
+    ALERTS_TABLE.insert(row)
+    _track_alerts([row], active=True)
     return row
 
 def mark_alert_resolved(alert_id, by_whom="patient"):
-    df = read_csv_to_df(ALERTS)
-    if df.empty:
+    rows = ALERTS_TABLE.lookup("alert_id", alert_id)
+    if rows.empty:
         return False
-    mask = df['alert_id'] == alert_id
-    if not mask.any():
-        return False
-    df.loc[mask, 'resolved'] = "yes"
-    df.loc[mask, 'resolved_by'] = by_whom
-    df.loc[mask, 'resolved_at'] = datetime.utcnow().isoformat()
-    write_df_to_csv(df, ALERTS)
+    ALERTS_TABLE.update(rows.index, {"resolved": "yes", "resolved_by": by_whom,
+                                     "resolved_at": datetime.utcnow().isoformat()})
+    _track_alerts(rows.to_dict(orient="records"), active=False)
     return True
 
 def resolve_alerts_for_stock(product_name, batch, by_whom="chemist"):
@@ -354,30 +935,31 @@ def resolve_alerts_for_stock(product_name, batch, by_whom="chemist"):
     Mark any unresolved alerts for this product_name+batch as resolved.
     Useful to call when deleting stock for that batch.
     """
-    df = read_csv_to_df(ALERTS)
+    df = ALERTS_TABLE.lookup("product_batch", product_name, batch)
     if df.empty:
         return 0
-    pn = str(product_name).strip().lower()
     bt = str(batch).strip()
-    mask = (df['product_name'].astype(str).str.lower() == pn) & (df['batch'].astype(str) == bt) & (df['resolved'] != "yes")
+    mask = (df['batch'].astype(str) == bt) & (df['resolved'] != "yes")
     if not mask.any():
         return 0
-    df.loc[mask, 'resolved'] = "yes"
-    df.loc[mask, 'resolved_by'] = by_whom
-    df.loc[mask, 'resolved_at'] = datetime.utcnow().isoformat()
-    write_df_to_csv(df, ALERTS)
+    ALERTS_TABLE.update(df[mask].index, {"resolved": "yes", "resolved_by": by_whom,
+                                         "resolved_at": datetime.utcnow().isoformat()})
+    _track_alerts(df[mask].to_dict(orient="records"), active=False)
     return mask.sum()
 
 def touch_alert_last_sent(alert_id):
-    df = read_csv_to_df(ALERTS)
-    if df.empty:
-        return False
-    mask = df['alert_id'] == alert_id
-    if not mask.any():
-        return False
-    df.loc[mask, 'last_sent_at'] = datetime.utcnow().isoformat()
-    write_df_to_csv(df, ALERTS)
-    return True
+    return touch_alerts_last_sent([alert_id]) > 0
+
+def touch_alerts_last_sent(alert_ids):
+    """Stamp last_sent_at on several alerts with a single table write; returns how many."""
+    rows = [ALERTS_TABLE.lookup("alert_id", a) for a in dict.fromkeys(alert_ids) if a]
+    rows = [r for r in rows if not r.empty]
+    if not rows:
+        return 0
+    rows = pd.concat(rows)
+    ALERTS_TABLE.update(rows.index, {"last_sent_at": datetime.utcnow().isoformat()})
+    _track_alerts(rows.to_dict(orient="records"))
+    return len(rows)
 
 def get_active_alerts():
     df = read_csv_to_df(ALERTS)
@@ -386,53 +968,187 @@ def get_active_alerts():
     df = df[df['resolved'] != "yes"]
     return df.to_dict(orient="records")
 
+# ---------------- medicine -> patient index ----------------
+# Inverted index from normalized (product_name, batch) to the patients it was
+# prescribed or dispensed to. Built once from prescriptions + sales, then kept
+# up to date by create_prescription / record_sale / index_dispensed_items.
+# If either table's row count moves behind our back (e.g. generate_prescription_qr.py
+# appending to the CSV) it is rebuilt on the next lookup.
+
+_med_patients = {}
+_med_index_counts = None
+_med_index_lock = threading.Lock()
+
+def _med_key(product_name, batch):
+    return (str(product_name or "").strip().lower(), str(batch or "").strip().lower())
+
+def _table_counts():
+    return (len(PRESCRIPTIONS_TABLE), len(SALES_TABLE))
+
+def _rebuild_med_index():
+    global _med_index_counts
+    _med_patients.clear()
+    pres_df = PRESCRIPTIONS_TABLE.frame()
+    if pres_df.empty:
+        _med_index_counts = _table_counts()
+        return
+    patient_of = dict(zip(pres_df["prescription_id"], pres_df["patient_id"]))
+    lines = [PRESCRIPTION_ITEMS_TABLE.frame(), SALES_TABLE.frame()]
+    # prescriptions appended by other writers have no items yet
+    itemized = set(lines[0]["prescription_id"]) if not lines[0].empty else set()
+    lines.append(pd.DataFrame([{"prescription_id": r["prescription_id"], **m}
+                               for r in prescription_records(pres_df[~pres_df["prescription_id"].isin(itemized)])
+                               for m in r["medications"]]))
+    for df in lines:
+        if df.empty:
+            continue
+        df = df.reindex(columns=["prescription_id", "product_name", "batch"], fill_value="")
+        for pid, product_name, batch in zip(df["prescription_id"], df["product_name"], df["batch"]):
+            if pid in patient_of:
+                _med_patients.setdefault(_med_key(product_name, batch), set()).add(patient_of[pid])
+    _med_index_counts = _table_counts()
+
+def _add_med_patients(patient_id, items):
+    global _med_index_counts
+    with _med_index_lock:
+        if _med_index_counts is None:
+            return  # not built yet; the first lookup builds it from the tables
+        for m in items:
+            _med_patients.setdefault(_med_key(m.get("product_name"), m.get("batch")), set()).add(patient_id)
+        _med_index_counts = _table_counts()
+
+def index_patient_meds(patient_id, medications):
+    """Record a new prescription's medicines in the index."""
+    if patient_id:
+        _add_med_patients(patient_id, medications or [])
+
+def index_dispensed_items(prescription_id, items):
+    """Record dispensed (product_name, batch) items against the prescription's patient."""
+    patient = PRESCRIPTIONS_TABLE.first("prescription_id", prescription_id)
+    if patient is not None and patient.get("patient_id"):
+        _add_med_patients(patient["patient_id"], items)
+        invalidate_patient(patient["patient_id"])
+
+def patients_for_med(product_name, batch):
+    """IDs of patients prescribed or dispensed this (product_name, batch) — a dict lookup."""
+    with _med_index_lock:
+        if _med_index_counts != _table_counts():
+            _rebuild_med_index()
+        return set(_med_patients.get(_med_key(product_name, batch), ()))
+
 def find_patients_for_med(product_name, batch):
     """
     Find patients who were prescribed or dispensed a given medicine batch.
-    Uses prescriptions.csv and patients.csv for lookup.
+    Uses the (product_name, batch) -> patient index, then patients.csv for the rows.
     """
-    pres_df = read_csv_to_df(PRESCRIPTIONS)
-    pat_df = read_csv_to_df(PATIENTS)
-    if pres_df.empty or pat_df.empty:
-        return []
-
     matches = []
-    for _, pres in pres_df.iterrows():
-        meds = []
-        try:
-            meds = json.loads(pres.get("medications_json", "[]"))
-        except Exception:
-            continue
-
-        for m in meds:
-            if (
-                str(m.get("product_name", "")).strip().lower() == product_name.lower()
-                and str(m.get("batch", "")).strip().lower() == batch.lower()
-            ):
-                pid = pres.get("patient_id")
-                p = pat_df[pat_df["patient_id"] == pid]
-                if not p.empty:
-                    matches.append(p.iloc[0].to_dict())
+    for patient_id in sorted(patients_for_med(product_name, batch)):
+        p = PATIENTS_TABLE.first("patient_id", patient_id)
+        if p is not None:
+            matches.append(p)
     return matches
 
+# ---------------- per-patient timeline ----------------
+# The patient app's reads (profile, prescriptions, dispensed items, active
+# alerts) are built once per patient and cached. Our own writes bump the
+# affected patients' generation, so a write for one patient leaves every other
+# patient's view (and ETag) alone; a view is also dropped when PATIENT_TABLES
+# change behind our back (another worker, an edited file), which we can't
+# attribute to a patient.
+
+PATIENT_TABLES = (PATIENTS_TABLE, PRESCRIPTIONS_TABLE, PRESCRIPTION_ITEMS_TABLE, SALES_TABLE, ALERTS_TABLE)
+
+_patient_views = {}          # patient_id -> (view, etag, (generation, foreign versions) it was built at)
+_patient_gen = Counter()     # patient_id -> number of our writes that touched the patient
+_batch_gen = 0               # number of invalidate_patients_for_batches() calls
+_patients_by_batch = {}      # lower(batch) -> ids of cached patients holding it
+_patient_lock = threading.Lock()
+
+def _foreign_patient_versions():
+    return tuple(t.foreign_version for t in PATIENT_TABLES)
+
+def invalidate_patient(patient_id):
+    if not patient_id:
+        return
+    with _patient_lock:
+        _patient_gen[patient_id] += 1
+        _patient_views.pop(patient_id, None)
+
+def invalidate_patients_for_batches(batches):
+    """Drop the cached views of patients whose prescriptions include any of `batches`."""
+    global _batch_gen
+    with _patient_lock:
+        _batch_gen += 1
+        for b in batches:
+            for patient_id in _patients_by_batch.pop(str(b or "").strip().lower(), ()):
+                _patient_gen[patient_id] += 1
+                _patient_views.pop(patient_id, None)
+
+def _build_patient_view(patient_id):
+    prescriptions = prescription_records(PRESCRIPTIONS_TABLE.lookup("patient_id", patient_id))
+    batches = {str(m.get("batch", "")).strip().lower()
+               for p in prescriptions for m in p["medications"]} - {""}
+
+    sales = [SALES_TABLE.lookup("prescription_id", p["prescription_id"]) for p in prescriptions]
+    sales = [f for f in sales if not f.empty]
+    dispensed = pd.concat(sales).sort_index().to_dict(orient="records") if sales else []
+
+    alerts = [ALERTS_TABLE.lookup("batch", b) for b in batches]
+    alerts = [f for f in alerts if not f.empty]
+    alerts = pd.concat(alerts).sort_index() if alerts else pd.DataFrame()
+    alerts = alerts[alerts["resolved"] != "yes"].to_dict(orient="records") if not alerts.empty else []
+
+    return {
+        "patient": PATIENTS_TABLE.first("patient_id", patient_id),
+        "prescriptions": prescriptions,
+        "dispensed": dispensed,
+        "alerts": alerts,
+    }, batches
+
+def patient_snapshot(patient_id):
+    """
+    (view, etag): the cached {patient, prescriptions, dispensed, alerts} view
+    of one patient and a digest of it, so a response can be tagged with
+    exactly the data it was built from (the same in every worker).
+    `patient` is None for an unknown id. Callers must not mutate the view.
+    """
+    with _patient_lock:
+        gen, batch_gen = _patient_gen[patient_id], _batch_gen
+        cached = _patient_views.get(patient_id)
+    key = (gen, _foreign_patient_versions())
+    if cached is not None and cached[2] == key:
+        return cached[0], cached[1]
+    view, batches = _build_patient_view(patient_id)
+    etag = hashlib.sha1(json.dumps(view, sort_keys=True, default=str).encode()).hexdigest()[:20]
+    with _patient_lock:
+        # a write for this patient (or for any batch, since we don't know this
+        # patient's batches until the view is built) may have landed mid-build:
+        # serve the view but don't keep it
+        if _patient_gen[patient_id] == gen and _batch_gen == batch_gen:
+            _patient_views[patient_id] = (view, etag, key)
+            for b in batches:
+                _patients_by_batch.setdefault(b, set()).add(patient_id)
+    return view, etag
+
+def patient_timeline(patient_id):
+    """The view from patient_snapshot()."""
+    return patient_snapshot(patient_id)[0]
+
 
 def add_alert(alert_type, message, created_at):
     """Append a new alert row to alerts.csv"""
+    row = {
+        "alert_type": alert_type,
+        "message": message,
+        "created_at": created_at
+    }
     try:
-        if not os.path.exists(ALERTS):
-            df = pd.DataFrame(columns=["alert_type", "message", "created_at"])
-        else:
-            df = pd.read_csv(ALERTS)
-
-        new_row = pd.DataFrame([{
-            "alert_type": alert_type,
-            "message": message,
-            "created_at": created_at
-        }])
-        df = pd.concat([df, new_row], ignore_index=True)
-        df.to_csv(ALERTS, index=False)
+        ALERTS_TABLE.insert(row)
     except Exception as e:
         print(f"Failed to record alert: {e}")
+        return
+    # not resolved, so it counts as active like any other unresolved row
+    _track_alerts([row], active=True)
 
 def process_qr_scan(pid, pharmacy_id=None):
     """
@@ -442,20 +1158,16 @@ def process_qr_scan(pid, pharmacy_id=None):
       - Records sale in sales.csv
       - Sends expiry alerts to patient if needed
     """
-    pres_df = read_csv_to_df(PRESCRIPTIONS)
-    if pres_df.empty:
+    if len(PRESCRIPTIONS_TABLE) == 0:
         return {"error": "no prescriptions found"}
 
     # Find prescription
-    match = pres_df[pres_df['prescription_id'] == pid]
+    match = PRESCRIPTIONS_TABLE.lookup("prescription_id", pid)
     if match.empty:
         return {"error": "not found"}
 
     pres = match.iloc[0].to_dict()
-    try:
-        meds = json.loads(pres.get("medications_json", "[]"))
-    except Exception:
-        meds = []
+    meds = prescription_medications(pres)
 
     # Deduct each medicine from stock
     for m in meds:
@@ -473,8 +1185,8 @@ def process_qr_scan(pid, pharmacy_id=None):
             print(f"⚠️ Could not decrement stock for {product_name} ({msg})")
 
     # Update prescription status
-    pres_df.loc[pres_df['prescription_id'] == pid, 'status'] = "dispensed"
-    write_df_to_csv(pres_df, PRESCRIPTIONS)
+    PRESCRIPTIONS_TABLE.update(match.index, {"status": "dispensed"})
+    invalidate_patient(pres.get("patient_id"))
 
     # ✅ Check and send expiry alerts to patient
     try:
@@ -486,70 +1198,129 @@ def process_qr_scan(pid, pharmacy_id=None):
 
     return {"message": f"Prescription {pid} dispensed successfully"}
 
-def send_email(recipient, subject, body, html=None):
-    sender_email = "riyakansal174@gmail.com"
-    sender_password = "uwte ykwd lmtv dstu"
+# Outgoing mail goes through a persistent outbox drained by background workers
+# (see mailer.py); send_email only queues the message.
+OUTBOX = Outbox(_open_table(
+    "email_outbox", EMAIL_OUTBOX, OUTBOX_COLUMNS,
+    indexes={"message_id": ("message_id",), "status": ("status",)},
+))
+# SMTP settings come from the environment (.env), like app.py's channel
+OUTBOX.add_transport("default", transport_from_env())
 
-    msg = MIMEMultipart('alternative')
-    msg["From"] = sender_email
-    msg["To"] = recipient
-    msg["Subject"] = subject
-    
-    # Attach plain text
-    msg.attach(MIMEText(body, "plain"))
-    
-    # Attach HTML if provided
-    if html:
-        msg.attach(MIMEText(html, "html"))
-
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
-        print(f"✅ Email sent to {recipient}")
-        return True
-    except Exception as e:
-        print(f"❌ Email sending failed: {e}")
+def send_email(recipient, subject, body, html=None):
+    if not recipient:
+        print("❌ Email not queued: no recipient")
         return False
+    OUTBOX.enqueue(recipient, subject, body, html)
+    print(f"📨 Email queued for {recipient}")
+    return True
 
-def check_expiry_and_create_alerts(days_threshold=15, low_stock_threshold=5):
+# ---------------- incremental alert evaluation ----------------
+# Stock mutations mark their (product, batch) keys dirty; the alert run then
+# only re-evaluates those keys. A full scan is left to the daily job.
+
+_dirty_stock_keys = set()
+_dirty_lock = threading.Lock()
+
+def mark_stock_dirty(product_name, batch):
+    """Queue a (product, batch) key for the next incremental alert evaluation."""
+    key = (str(product_name or "").strip().lower(), str(batch or "").strip().lower())
+    with _dirty_lock:
+        _dirty_stock_keys.add(key)
+
+def take_dirty_stock_keys():
+    """Return and clear the queued dirty keys."""
+    global _dirty_stock_keys
+    with _dirty_lock:
+        keys, _dirty_stock_keys = _dirty_stock_keys, set()
+    return keys
+
+# Expiry status only changes on two dates per batch: when the expiring-soon
+# window opens and the day after it expires. Each evaluated row is filed under
+# its next such date, so the daily run only re-checks the rows that are due.
+
+_expiry_wheel = {}      # date -> set of (product, batch) keys
+_wheel_dates = []       # min-heap of the dates in _expiry_wheel
+
+def next_alert_change(days_left, days_threshold=15, today=None):
+    """Date on which a row `days_left` days from expiry next changes alert status (None if never)."""
+    today = today or datetime.utcnow().date()
+    if days_left > days_threshold:
+        return today + timedelta(days=days_left - days_threshold)
+    if days_left >= 0:
+        return today + timedelta(days=days_left + 1)
+    return None
+
+def schedule_expiry_check(product_name, batch, when):
+    key = (str(product_name or "").strip().lower(), str(batch or "").strip().lower())
+    with _dirty_lock:
+        bucket = _expiry_wheel.get(when)
+        if bucket is None:
+            bucket = _expiry_wheel[when] = set()
+            heapq.heappush(_wheel_dates, when)
+        bucket.add(key)
+
+def clear_expiry_schedule():
+    with _dirty_lock:
+        _expiry_wheel.clear()
+        _wheel_dates.clear()
+
+def take_due_stock_keys(today=None):
+    """Return and remove every scheduled key whose date is on or before `today`."""
+    today = today or datetime.utcnow().date()
+    keys = set()
+    with _dirty_lock:
+        while _wheel_dates and _wheel_dates[0] <= today:
+            keys |= _expiry_wheel.pop(heapq.heappop(_wheel_dates))
+    return keys
+
+def _frame_for_keys(table, keys):
+    frames = [table.lookup("product_batch", p, b) for p, b in keys]
+    frames = [f for f in frames if not f.empty]
+    return pd.concat(frames) if frames else pd.DataFrame()
+
+def check_expiry_and_create_alerts(days_threshold=15, low_stock_threshold=5, keys=None):
     """
     Scans MED_STOCK for expiring or low-stock medicines.
     Creates alert entries in alerts.csv (if not already exists).
+    With `keys` (a set of (product, batch) pairs) only those stock rows are
+    evaluated; without it the whole table is scanned and the expiry schedule
+    is rebuilt from scratch.
     Returns list of new alert dicts created.
     """
-    stock_df = read_csv_to_df(MED_STOCK)
+    if keys is None:
+        clear_expiry_schedule()
+        stock_df = read_csv_to_df(MED_STOCK)
+    else:
+        stock_df = _frame_for_keys(STOCK_TABLE, keys)
     if stock_df.empty:
         return []
 
-    alerts_df = read_csv_to_df(ALERTS)
-    if alerts_df.empty:
-        alerts_df = pd.DataFrame(columns=["alert_id", "product_name", "batch", "alert_type",
-                                          "exp", "days_to_expiry", "created_at", "resolved",
-                                          "last_sent"])
-
     new_alerts = []
+    seen = set()
 
-    from datetime import datetime
-    now = datetime.utcnow().date()
+    # Parse every expiry in one pass (rows with no parseable expiry are skipped)
+    exp_col = stock_df["exp"] if "exp" in stock_df.columns else pd.Series("", index=stock_df.index)
+    if "expiry" in stock_df.columns:
+        exp_col = exp_col.where(exp_col.astype(str) != "", stock_df["expiry"])
+    exp_col = exp_col.astype(str).str.strip()
+    days_col = expiry_days(exp_col)
 
-    for _, row in stock_df.iterrows():
+    for label, row in stock_df.iterrows():
         product_name = str(row.get("product_name", "")).strip()
         batch = str(row.get("batch", "")).strip()
-        exp_raw = str(row.get("exp", "") or row.get("expiry", "")).strip()
+        exp_raw = exp_col[label]
         qty = int(row.get("qty", 0) or 0)
 
         if not product_name or not batch:
             continue
 
-        # Parse expiry safely
-        days_left = None
-        exp_date = None
-        try:
-            exp_date = _try_parse_date(exp_raw)
-            days_left = (exp_date - now).days
-        except Exception:
+        if pd.isna(days_col[label]):
             continue
+        days_left = int(days_col[label])
+        when = next_alert_change(days_left, days_threshold)
+        if when is not None:
+            schedule_expiry_check(product_name, batch, when)
 
         alert_type = None
         if days_left is not None:
@@ -565,14 +1336,10 @@ def check_expiry_and_create_alerts(days_threshold=15, low_stock_threshold=5):
             continue
 
         # Skip duplicates (same product+batch+alert_type not resolved)
-        existing = alerts_df[
-            (alerts_df["product_name"].str.lower() == product_name.lower()) &
-            (alerts_df["batch"].str.lower() == batch.lower()) &
-            (alerts_df["alert_type"].str.lower() == alert_type.lower()) &
-            (alerts_df["resolved"] != "yes")
-        ]
-        if not existing.empty:
+        key = _alert_key(product_name, batch, alert_type)
+        if key in seen or _alert_exists(product_name, batch, alert_type):
             continue
+        seen.add(key)
 
         alert_id = str(uuid.uuid4())
         new_alert = {
@@ -586,10 +1353,10 @@ def check_expiry_and_create_alerts(days_threshold=15, low_stock_threshold=5):
             "resolved": "no",
             "last_sent": ""
         }
-        alerts_df = pd.concat([alerts_df, pd.DataFrame([new_alert])], ignore_index=True)
         new_alerts.append(new_alert)
 
-    write_df_to_csv(alerts_df, ALERTS)
+    ALERTS_TABLE.insert(new_alerts)
+    _track_alerts(new_alerts, active=True)
     return new_alerts
 def check_dispensed_medicine_and_alert(prescription_id):
     """
@@ -597,22 +1364,14 @@ def check_dispensed_medicine_and_alert(prescription_id):
     Send email alert to the patient if needed.
     Returns list of alerts sent.
     """
-    pres_df = read_csv_to_df(PRESCRIPTIONS)
-    if pres_df.empty:
-        return []
-    
-    pres_row = pres_df[pres_df['prescription_id'] == prescription_id]
+    pres_row = PRESCRIPTIONS_TABLE.lookup("prescription_id", prescription_id)
     if pres_row.empty:
         return []
     
     patient_id = pres_row.iloc[0]['patient_id']
     
     # Get patient details
-    pat_df = read_csv_to_df(PATIENTS)
-    if pat_df.empty:
-        return []
-    
-    patient_row = pat_df[pat_df['patient_id'] == patient_id]
+    patient_row = PATIENTS_TABLE.lookup("patient_id", patient_id)
     if patient_row.empty:
         return []
     
@@ -625,13 +1384,9 @@ def check_dispensed_medicine_and_alert(prescription_id):
         return []
     
     # Get medications from prescription
-    try:
-        meds = json.loads(pres_row.iloc[0].get('medications_json', '[]'))
-    except Exception:
-        return []
+    meds = prescription_medications(pres_row.iloc[0].to_dict())
     
     alerts_sent = []
-    stock_df = read_csv_to_df(MED_STOCK)
     
     for med in meds:
         product_name = str(med.get('product_name', '')).strip()
@@ -641,10 +1396,7 @@ def check_dispensed_medicine_and_alert(prescription_id):
             continue
         
         # Find the medicine in stock
-        stock_row = stock_df[
-            (stock_df['product_name'].str.lower() == product_name.lower()) &
-            (stock_df['batch'].str.lower() == batch.lower())
-        ]
+        stock_row = STOCK_TABLE.lookup("product_batch", product_name, batch)
         
         if stock_row.empty:
             continue
@@ -654,7 +1406,9 @@ def check_dispensed_medicine_and_alert(prescription_id):
             continue
         
         try:
-            exp_date = _try_parse_date(exp_raw)
+            exp_date = _parse_expiry(exp_raw)
+            if exp_date is None:
+                raise ValueError("unrecognized date format: " + exp_raw)
             days_left = (exp_date - datetime.utcnow().date()).days
             
             # If expired or expiring within 15 days
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
-import { uploadBill, getInventory, getAlerts, deleteStock, getPrescription, dispensePrescription } from '../services/api';
+import { uploadBill, getInventoryRows, getAlerts, deleteStock, getPrescription, dispensePrescription } from '../services/api';
 import { Upload, Package, AlertTriangle, Trash2, ArrowLeft, Search, QrCode, Eye, FileText, CheckCircle, XCircle } from 'lucide-react';
 
 export default function PharmacyDashboard() {
@@ -16,7 +16,7 @@ export default function PharmacyDashboard() {
   const [loading, setLoading] = useState(false);
 
   const loadData = () => {
-    getInventory().then(r => setInventory(r.data)).catch(() => setInventory([]));
+    getInventoryRows().then(setInventory).catch(() => setInventory([]));
     getAlerts().then(r => setAlerts(r.data)).catch(() => setAlerts([]));
   };
 
@@ -11,11 +11,23 @@ export const uploadBill = (file) => {
 };
 
 // ---------- FETCH DATA ----------
-export const getInventory = () => axios.get(`${BASE}/inventory`);
-export const getAlerts = () => axios.get(`${BASE}/alerts`);
-export const getPatients = () => axios.get(`${BASE}/patients`);
+// params: optional { expiring_within, include_expired, next_to_expire }
+export const getInventory = (params) => axios.get(`${BASE}/inventory`, { params });
+// list endpoints also take optional { limit, after, fields, from, to } and filters;
+// the cursor for the next page comes back in the X-Next-Cursor header
+export const getAlerts = (params) => axios.get(`${BASE}/alerts`, { params });
+export const getPatients = (params) => axios.get(`${BASE}/patients`, { params });
 export const getPrescription = (pid) => axios.get(`${BASE}/prescription/${pid}`);
 
+// With { format: "columnar" } list endpoints return { count, fields, columns: { field: [values] } };
+// rowsFromColumns turns that back into the usual array of row objects.
+export const rowsFromColumns = ({ count, fields, columns }) =>
+  Array.from({ length: count }, (_, i) =>
+    Object.fromEntries(fields.map((f) => [f, columns[f][i]]))
+  );
+export const getInventoryRows = (params) =>
+  getInventory({ ...params, format: "columnar" }).then((r) => rowsFromColumns(r.data));
+
 // ---------- PATIENT & PRESCRIPTION ----------
 export const registerPatient = (data) =>
   axios.post(`${BASE}/register_patient`, data);
@@ -23,6 +35,10 @@ export const registerPatient = (data) =>
 export const createPrescription = (data) =>
   axios.post(`${BASE}/create_prescription`, data);
 
+// bulk create: list of createPrescription payloads, all-or-nothing
+export const createPrescriptions = (prescriptions) =>
+  axios.post(`${BASE}/create_prescriptions`, { prescriptions });
+
 // ---------- QR SCAN / Dispense ----------
 export const scanQr = (payload) => axios.post(`${BASE}/scan_qr`, payload);
 export const dispensePrescription = (payload) => axios.post(`${BASE}/scan_qr`, payload);
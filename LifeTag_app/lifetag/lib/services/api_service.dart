@@ -122,9 +122,10 @@ class ApiService {
   /// Get all prescriptions for a patient
   Future<List<Prescription>> getPrescriptionsForPatient(String patientId) async {
     try {
-      // Since backend doesn't have a direct endpoint, we fetch all and filter
+      // The backend filters by patient_id; the check below keeps older servers working
       final response = await http.get(
-        Uri.parse('$baseUrl/prescriptions'),
+        Uri.parse('$baseUrl/prescriptions')
+            .replace(queryParameters: {'patient_id': patientId}),
         headers: _headers,
       );
 